@@ -17,6 +17,7 @@ data ModuleInfo = ModuleInfo
     , _exportList :: Maybe [String]
     , _imports :: [ImportInfo]
     , _declarations :: [DeclarationInfo]
+    , _bindings :: [BindingInfo]
     }
     deriving (Show)
 
@@ -26,6 +27,7 @@ instance Json.ToJSON ModuleInfo where
         , "exportList" .= Json.Null
         , "imports" .= _imports info
         , "declarations" .= _declarations info
+        , "bindings" .= _bindings info
         ]
 
 -- | Information about import
@@ -59,6 +61,20 @@ instance Json.ToJSON DeclarationInfo where
         , "column" .= c
         ]
 
+-- | Information about a top-level function or value binding.
+data BindingInfo = BindingInfo
+    { _bindingLocation :: H.SrcLoc
+    , _nameOfBinding :: String
+    }
+    deriving (Show)
+
+instance Json.ToJSON BindingInfo where
+    toJSON (BindingInfo (H.SrcLoc _ l c) name) = Json.object
+        [ "identifier" .= name
+        , "line" .= l
+        , "column" .= c
+        ]
+
 -- | Process a single file's contents.
 analyzeModule :: String -> Either String ModuleInfo
 analyzeModule source = case H.parseFileContents source of
@@ -70,6 +86,7 @@ analyzeModule source = case H.parseFileContents source of
             , _exportList = Nothing
             , _imports = map infoOfImport imports
             , _declarations = concatMap nameOfDecl declarations
+            , _bindings = concatMap bindingOfDecl declarations
             }
 
 -- | Get module name for import
@@ -92,6 +109,13 @@ nameOfDecl decl = case decl of
     H.ClassDecl loc _ n _ _ _ -> [DeclarationInfo loc (identOfName n) "(class)"]
     _ -> []
 
+-- | Get the name and location of a top-level binding (with or without type signature).
+bindingOfDecl :: H.Decl -> [BindingInfo]
+bindingOfDecl decl = case decl of
+    H.FunBind (H.Match loc n _ _ _ _ : _) -> [BindingInfo loc (identOfName n)]
+    H.PatBind loc (H.PVar n) _ _ _ -> [BindingInfo loc (identOfName n)]
+    _ -> []
+
 identOfName :: H.Name -> String
 identOfName name = case name of
     H.Ident s -> s
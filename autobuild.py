@@ -3,6 +3,7 @@ import sublime
 import sublime_plugin
 
 from sublime_haskell_common import attach_sandbox, get_cabal_project_dir_and_name_of_view, call_and_wait, log, get_setting
+from ghcmod import check_saved_file
 
 class SublimeHaskellAutobuild(sublime_plugin.EventListener):
     def on_post_save(self, view):
@@ -13,14 +14,18 @@ class SublimeHaskellAutobuild(sublime_plugin.EventListener):
 
         # auto build enabled and file within a cabal project
         if auto_build_enabled and cabal_project_dir is not None:
-            view.window().run_command('sublime_haskell_build')
-        # try to ghc-mod check
-        elif auto_check_enabled and auto_lint_enabled:
-            view.window().run_command('sublime_haskell_ghc_mod_check_and_lint')
-        elif auto_check_enabled:
-            view.window().run_command('sublime_haskell_ghc_mod_check')
-        elif auto_lint_enabled:
-            view.window().run_command('sublime_haskell_ghc_mod_lint')
+            if get_auto_build_mode(cabal_project_name) == 'check':
+                view.window().run_command('sublime_haskell_typecheck')
+            else:
+                view.window().run_command('sublime_haskell_build')
+        # try to ghc-mod check, files saved together are checked at once
+        elif auto_check_enabled or auto_lint_enabled:
+            check_saved_file(view, auto_check_enabled, auto_lint_enabled)
+
+def get_auto_build_mode(cabal_project_name):
+    """Build mode used on save for project: 'build' or 'check' (typecheck only)"""
+    project_modes = get_setting('auto_build_mode_projects') or {}
+    return project_modes.get(cabal_project_name, get_setting('auto_build_mode', 'build'))
 
 def current_cabal_build():
     """Current cabal build command"""
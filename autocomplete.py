@@ -1,3 +1,4 @@
+import heapq
 import json
 import os
 import re
@@ -7,14 +8,13 @@ import subprocess
 import threading
 import time
 
-from sublime_haskell_common import PACKAGE_PATH, get_setting, get_setting_async, get_cabal_project_dir_of_file, get_cabal_project_dir_of_view, call_and_wait, call_ghcmod_and_wait, log, wait_for_window, output_error, get_settings, attach_sandbox, is_enabled_haskell_command, get_cabal_in_dir
+from sublime_haskell_common import PACKAGE_PATH, get_setting, get_setting_async, get_cabal_project_dir_of_file, get_cabal_project_dir_of_view, call_and_wait, call_no_wait, call_ghcmod_and_wait, activity_governor, log, wait_for_window, output_error, get_settings, attach_sandbox, try_attach_sandbox, is_enabled_haskell_command, get_cabal_in_dir, get_settings_version, get_tool_environment, lower_process_priority, metrics, BoundedCache, PRIORITY_INTERACTIVE
+from indexhost import ModuleIndex
+from filewatcher import FileWatcher, DELETED, OVERFLOW
 
 # Completion text longer than this is ellipsized:
 MAX_COMPLETION_LENGTH = 37
 
-# If true, files that have not changed will not be re-inspected.
-CHECK_MTIME = True
-
 MODULE_INSPECTOR_SOURCE_PATH = os.path.join(PACKAGE_PATH, 'ModuleInspector.hs')
 MODULE_INSPECTOR_EXE_PATH = os.path.join(PACKAGE_PATH, 'ModuleInspector')
 MODULE_INSPECTOR_OBJ_DIR = os.path.join(PACKAGE_PATH, 'obj')
@@ -24,8 +24,19 @@ CABAL_INSPECTOR_OBJ_DIR = os.path.join(PACKAGE_PATH, 'obj')
 
 OUTPUT_PATH = os.path.join(PACKAGE_PATH, 'module_info.cache')
 
-# The agent sleeps this long between inspections.
-AGENT_SLEEP_DURATION = 5.0
+INDEX_HOST_PATH = os.path.join(PACKAGE_PATH, 'indexhost.py')
+
+# Seconds to wait for answer of index host to queries
+INDEX_QUERY_TIMEOUT = 2.0
+
+# Number of cached completion lists of index host
+IDENTIFIERS_CACHE_SIZE = 64
+
+# Priorities of files in inspection queue, files with lower value are inspected first
+INSPECT_ACTIVE = 0
+INSPECT_OPEN = 1
+INSPECT_IMPORTS = 2
+INSPECT_REST = 3
 
 # Checks if we are in a LANGUAGE pragma.
 LANGUAGE_RE = re.compile(r'.*{-#\s+LANGUAGE.*')
@@ -51,22 +62,16 @@ class AutoCompletion(object):
     def __init__(self):
         self.language_completions = []
         self.module_completions = []
-        # Module info (dictionary: filename => info)
-        # info is:
-        #   moduleName - name of module
-        #   exportList - list of export (strings)
-        #   imports - list of import (strings), where import is:
-        #     importName - name of imported module
-        #     qualified - is import qualified?
-        #     as - alias of module (string or null)
-        #   declarations - list of declarations, where declaration is:
-        #     info - type info (string "(data)", "(type)" or "(class)")
-        #     identifier - declaration identifier
-        self.info_lock = threading.Lock()
-        self.info = {}
-        # Standard module completions (dictionary: module name => completions):
-        self.std_info_lock = threading.Lock()
-        self.std_info = {}
+        # Index of module info (see ModuleIndex), in plugin process or IndexHostClient
+        self.index = create_local_index()
+        # Index host is not queried on completion, completions are answered from cache
+        # and refreshed in background (dictionary: (filename, qualified module) => (index version, identifiers))
+        self.identifiers = BoundedCache(IDENTIFIERS_CACHE_SIZE, 'identifiers')
+        self.identifiers_lock = threading.Lock()
+        # Keys of identifiers being refreshed
+        self.identifiers_pending = set()
+        # Incremented when module info changes
+        self.index_version = 0
 
         # Currently used projects
         # name => project where project is:
@@ -101,52 +106,41 @@ class AutoCompletion(object):
         if has_q:
             completions.extend(self.get_module_completions_for(qualified_prefix))
 
-        with self.info_lock:
-
-            moduleImports = []
-            # Use completion only from qualified_module
-            if has_q:
-                if current_file_name in self.info:
-                    current_info = self.info[current_file_name]
-                    if 'imports' in current_info:
-                        # if qualified_module is alias, find its original name
-                        # e.g. for 'import Data.Text as T' return 'Data.Text' for 'T'
-                        moduleImports.extend([m['importName'] for m in self.info[current_file_name]['imports'] if m['as'] == qualified_module])
-                moduleImports.append(qualified_module)
-            else:
-                # list of imports, imported unqualified
-                if current_file_name in self.info:
-                    current_info = self.info[current_file_name]
-                    if 'imports' in current_info:
-                        moduleImports.extend([m['importName'] for m in self.info[current_file_name]['imports'] if not m['qualified']])
-
-            for file_name, file_info in self.info.items():
-                if 'error' in file_info:
-                    # There was an error parsing this file; skip it
-                    continue
-
-                # File is imported, add to completion list
-                if file_info['moduleName'] in moduleImports:
-                    for d in file_info['declarations']:
-                        identifier = d['identifier']
-                        declaration_info = d['info']
-                        # TODO: Show the declaration info somewhere.
-                        completions.append((identifier[:MAX_COMPLETION_LENGTH], identifier))
-
-            # Completion for modules by ghc-mod browse
-            with self.std_info_lock:
-                for mi in moduleImports:
-                    if mi not in self.std_info:
-                        # Module not imported, skip it
-                        continue
-
-                    std_module = self.std_info[mi]
-
-                    for v in std_module:
-                        completions.append((v[:MAX_COMPLETION_LENGTH], v))
+        identifiers = self.get_identifiers(current_file_name, qualified_module)
+        completions.extend([(identifier[:MAX_COMPLETION_LENGTH], identifier) for identifier in identifiers])
 
         return list(set(completions))
 
+    def get_identifiers(self, filename, qualified_module):
+        "Returns identifiers of index completions, cached ones if index runs in index host"
+        if not isinstance(self.index, IndexHostClient):
+            return self.index.completions(filename, qualified_module) or []
+        key = (filename, qualified_module)
+        cached = self.identifiers.get(key)
+        with self.identifiers_lock:
+            version = self.index_version
+            refresh = (cached is None or cached[0] != version) and key not in self.identifiers_pending
+            if refresh:
+                self.identifiers_pending.add(key)
+        if refresh:
+            threading.Thread(target=self.refresh_identifiers, args=(key, version)).start()
+        return cached[1] if cached else []
+
+    def refresh_identifiers(self, key, version):
+        identifiers = None
+        try:
+            identifiers = self.index.completions(*key)
+        finally:
+            with self.identifiers_lock:
+                self.identifiers_pending.discard(key)
+            if identifiers is not None:
+                self.identifiers.put(key, (version, identifiers))
+
+    def index_changed(self):
+        "Called when module info changes, cached identifiers are refreshed on next completion"
+        with self.identifiers_lock:
+            self.index_version += 1
+
     def get_import_completions(self, view, prefix, locations):
 
         # Contents of the current line up to the cursor
@@ -187,21 +181,125 @@ class AutoCompletion(object):
         return list(set([ (unicode(module_next_name(m)),) * 2 for m in self.module_completions if m.startswith(qualified_prefix) ]))
 
 
+def create_local_index():
+    "Index in plugin process, its inspector processes are run with background priority"
+    return ModuleIndex(lambda command: call_and_wait(command), log)
+
+class IndexHostClient(object):
+    """
+    Proxy of ModuleIndex, which runs in separate process (indexhost.py),
+    so that inspection and JSON decoding don't hold plugin host.
+    Methods of ModuleIndex are called by name and return None if host doesn't answer.
+    on_exit is called from reader thread when host process terminates.
+    """
+    # Methods, which can take long time, are waited without timeout
+    LONG_METHODS = ['inspect', 'load_standard_module']
+
+    def __init__(self, python, on_exit):
+        popen_kwargs = { 'stderr': None }
+        lower_process_priority(popen_kwargs)
+        self.process = call_no_wait([python, INDEX_HOST_PATH], **popen_kwargs)
+        self.on_exit = on_exit
+        self.lock = threading.Lock()
+        self.alive = True
+        self.next_id = 0
+        # Requests waiting for response (dictionary: id => [event, response])
+        self.pending = {}
+        reader = threading.Thread(target=self.read_responses)
+        reader.daemon = True
+        reader.start()
+
+    def call(self, method, params, timeout):
+        with self.lock:
+            if not self.alive:
+                return None
+            self.next_id += 1
+            request_id = self.next_id
+            waiter = [threading.Event(), None]
+            self.pending[request_id] = waiter
+            try:
+                self.process.stdin.write(json.dumps({ 'id': request_id, 'method': method, 'params': params }) + '\n')
+                self.process.stdin.flush()
+            except IOError, e:
+                del self.pending[request_id]
+                log('index host failed: {0}'.format(e))
+                return None
+        waiter[0].wait(timeout)
+        with self.lock:
+            self.pending.pop(request_id, None)
+        response = waiter[1]
+        if response is None:
+            log('index host did not answer {0}'.format(method))
+            return None
+        if 'error' in response:
+            log('index host failed on {0}: {1}'.format(method, response['error']))
+            return None
+        return response['result']
+
+    def __getattr__(self, method):
+        timeout = None if method in IndexHostClient.LONG_METHODS else INDEX_QUERY_TIMEOUT
+        return lambda *params: self.call(method, list(params), timeout)
+
+    def read_responses(self):
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                break
+            message = json.loads(line)
+            if 'log' in message:
+                log(u'index host: {0}'.format(message['log']))
+                continue
+            with self.lock:
+                waiter = self.pending.get(message['id'])
+            if waiter:
+                waiter[1] = message
+                waiter[0].set()
+        # Host terminated, wake up waiting requests
+        with self.lock:
+            self.alive = False
+            for waiter in self.pending.values():
+                waiter[0].set()
+        self.on_exit()
+
 autocompletion = AutoCompletion()
 
+def query_index(query, on_result):
+    """
+    Run query of index in background, so that index host doesn't block editor.
+    on_result(result) is called in main thread, if index answered (query returned not None).
+    """
+    def run():
+        result = query()
+        def report():
+            if result is None:
+                sublime.status_message('SublimeHaskell: Index is busy, try again later')
+                return
+            on_result(result)
+        sublime.set_timeout(report, 0)
+    threading.Thread(target=run).start()
+
+def query_all_declarations():
+    "Returns (declarations, std_declarations) of index or None if index doesn't answer"
+    declarations = autocompletion.index.declarations()
+    std_declarations = autocompletion.index.std_declarations()
+    if declarations is None or std_declarations is None:
+        return None
+    return (declarations, std_declarations)
+
 class SublimeHaskellBrowseDeclarations(sublime_plugin.WindowCommand):
     def run(self):
+        query_index(query_all_declarations, self.show_declarations)
+
+    def show_declarations(self, all_declarations):
+        (declarations, std_declarations) = all_declarations
         self.names = []
         self.declarations = []
-        for f, v in autocompletion.info.items():
-            if 'declarations' in v:
-                for d in v['declarations']:
-                    self.names.append(d['identifier'])
-                    self.declarations.append(v['moduleName'] + ': '  + d['identifier'] + ' ' + d['info'])
-        for m, decls in autocompletion.std_info.items():
-            for decl in decls:
-                self.names.append(decl)
-                self.declarations.append(m + ': ' + decl)
+        for f, module_name, d in declarations:
+            self.names.append(d['identifier'])
+            self.declarations.append(module_name + ': '  + d['identifier'] + ' ' + d['info'])
+        for m, decl in std_declarations:
+            self.names.append(decl)
+            self.declarations.append(m + ': ' + decl)
 
         self.window.show_quick_panel(self.declarations, self.on_done)
 
@@ -221,13 +319,14 @@ class SublimeHaskellBrowseDeclarations(sublime_plugin.WindowCommand):
 
 class SublimeHaskellGoToAnyDeclaration(sublime_plugin.WindowCommand):
     def run(self):
+        query_index(lambda: autocompletion.index.declarations(), self.show_declarations)
+
+    def show_declarations(self, declarations):
         self.files = []
         self.declarations = []
-        for f, v in autocompletion.info.items():
-            if 'declarations' in v:
-                for d in v['declarations']:
-                    self.files.append([f, str(d['line']), str(d['column'])])
-                    self.declarations.append([d['identifier'] + ' ' + d['info'], v['moduleName'] + ':' + str(d['line']) + ':' + str(d['column'])])
+        for f, module_name, d in declarations:
+            self.files.append([f, str(d['line']), str(d['column'])])
+            self.declarations.append([d['identifier'] + ' ' + d['info'], module_name + ':' + str(d['line']) + ':' + str(d['column'])])
         self.window.show_quick_panel(self.declarations, self.on_done)
 
     def on_done(self, idx):
@@ -241,12 +340,12 @@ class SublimeHaskellGoToAnyDeclaration(sublime_plugin.WindowCommand):
 class SublimeHaskellGoToDeclaration(sublime_plugin.TextCommand):
     def run(self, edit):
         ident = self.view.substr(self.view.word(self.view.sel()[0]))
-        for f, v in autocompletion.info.items():
-            if 'declarations' in v:
-                for d in v['declarations']:
-                    if d['identifier'] == ident:
-                        self.view.window().open_file(':'.join([f, str(d['line']), str(d['column'])]), sublime.ENCODED_POSITION)
-                        return
+        query_index(lambda: autocompletion.index.find_declaration(ident), self.go_to_declaration)
+
+    def go_to_declaration(self, locations):
+        if locations:
+            location = locations[0]
+            self.view.window().open_file(':'.join([location[0], str(location[1]), str(location[2])]), sublime.ENCODED_POSITION)
 
     def is_enabled(self):
         return is_enabled_haskell_command(False)
@@ -290,15 +389,22 @@ class SublimeHaskellAutocomplete(sublime_plugin.EventListener):
             return
 
         sublime.status_message('SublimeHaskell: Updating ghc_mod completions...')
+        # ghc-mod can run long, don't block editor
+        threading.Thread(target=self.load_ghcmod_completions).start()
+
+    def load_ghcmod_completions(self):
+        try:
+            # Init LANGUAGE completions
+            autocompletion.language_completions = (call_ghcmod_and_wait(['lang'], priority = PRIORITY_INTERACTIVE) or '').splitlines()
+            log("Reading LANGUAGE completions from ghc-mod")
+
+            # Init import module completion
+            autocompletion.module_completions = (call_ghcmod_and_wait(['list'], priority = PRIORITY_INTERACTIVE) or '').splitlines()
+        except Exception, e:
+            log('updating ghc-mod completions failed: {0}'.format(e))
+            return
 
-        # Init LANGUAGE completions
-        autocompletion.language_completions = call_ghcmod_and_wait(['lang']).splitlines()
-        log("Reading LANGUAGE completions from ghc-mod")
-
-        # Init import module completion
-        autocompletion.module_completions = call_ghcmod_and_wait(['list']).splitlines()
-
-        sublime.status_message('SublimeHaskell: Updating ghc_mod completions ' + u" \u2714")
+        sublime.set_timeout(lambda: sublime.status_message('SublimeHaskell: Updating ghc_mod completions ' + u" \u2714"), 0)
 
     def get_special_completions(self, view, prefix, locations):
 
@@ -330,7 +436,7 @@ class SublimeHaskellAutocomplete(sublime_plugin.EventListener):
         return None
 
     def on_query_completions(self, view, prefix, locations):
-        begin_time = time.clock()
+        begin_time = time.time()
         # Only suggest symbols if the current file is part of a Cabal project.
         # TODO: Only suggest symbols from within this project.
 
@@ -342,8 +448,7 @@ class SublimeHaskellAutocomplete(sublime_plugin.EventListener):
         if not completions:
             completions = autocompletion.get_completions(view, prefix, locations)
 
-        end_time = time.clock()
-        log('time to get completions: {0} seconds'.format(end_time - begin_time))
+        metrics.record('completions', time.time() - begin_time)
         # Don't put completions with special characters (?, !, ==, etc.)
         # into completion because that wipes all default Sublime completions:
         # See http://www.sublimetext.com/forum/viewtopic.php?t=8659
@@ -362,6 +467,53 @@ class SublimeHaskellAutocomplete(sublime_plugin.EventListener):
         if filename:
             self.inspector.mark_file_dirty(filename)
 
+    def on_load(self, view):
+        # Restored tabs are loaded on startup too, only active view goes first
+        self.inspect_view(view, INSPECT_OPEN)
+
+    def on_activated(self, view):
+        self.inspect_view(view, INSPECT_ACTIVE)
+
+    def inspect_view(self, view, priority):
+        "Queue file of view for inspection, it's skipped if not changed since last inspection"
+        filename = view.file_name()
+        if filename and filename.endswith('.hs'):
+            self.inspector.queue.put(filename, priority)
+
+class InspectionQueue(object):
+    """
+    Files to inspect ordered by priority.
+    Each file is queued once, with the highest of its priorities.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Heap of (priority, sequence number, filename), entries with outdated priority are skipped
+        self.heap = []
+        self.sequence = 0
+        # Priorities of queued files (dictionary: filename => priority)
+        self.priorities = {}
+
+    def put(self, filename, priority):
+        with self.condition:
+            current = self.priorities.get(filename)
+            if current is not None and current <= priority:
+                return
+            self.priorities[filename] = priority
+            self.sequence += 1
+            heapq.heappush(self.heap, (priority, self.sequence, filename))
+            self.condition.notify()
+
+    def get(self):
+        "Wait for file and return (filename, priority) of the most important one"
+        with self.condition:
+            while True:
+                while not self.heap:
+                    self.condition.wait()
+                (priority, sequence, filename) = heapq.heappop(self.heap)
+                if self.priorities.get(filename) == priority:
+                    del self.priorities[filename]
+                    return (filename, priority)
+
 class InspectorAgent(threading.Thread):
     def __init__(self):
         # Call the superclass constructor:
@@ -369,9 +521,17 @@ class InspectorAgent(threading.Thread):
         # Make this thread daemonic so that it won't prevent the program
         # from exiting.
         self.daemon = True
-        # Files that need to be re-inspected:
-        self.dirty_files_lock = threading.Lock()
-        self.dirty_files = []
+        # Files that need to be (re-)inspected:
+        self.queue = InspectionQueue()
+        self.projects_lock = threading.Lock()
+        # Source files of projects, which are queued for inspection (dictionary: cabal dir => list of files)
+        self.project_files = {}
+        # Saved files, projects of which must be rescanned for changes
+        self.saved_files = set()
+        # Settings version, index is configured for
+        self.index_settings_version = None
+        # Watches projects for changes made outside of editor
+        self.file_watcher = None
 
     def run(self):
         # Compile the CabalInspector:
@@ -405,55 +565,138 @@ class InspectorAgent(threading.Thread):
 
         sublime.set_timeout(lambda: sublime.status_message('Compiling Haskell ModuleInspector' + u" \u2714"), 0)
 
+        self.start_index_host()
+
+        if get_setting_async('watch_project_files'):
+            self.file_watcher = FileWatcher(self.on_files_changed, get_setting_async('file_watch_poll_interval', 5))
+
         # For first time, inspect all open folders and files
         wait_for_window(lambda w: self.mark_all_files(w))
 
         # TODO: If compilation failed, we can't proceed; handle this.
-        # Periodically wake up and see if there is anything to inspect.
+        # Inspect queued files, most important first.
         while True:
-            files_to_reinspect = []
-            with self.dirty_files_lock:
-                files_to_reinspect = self.dirty_files
-                self.dirty_files = []
-            # Find the cabal project corresponding to each "dirty" file:
-            cabal_dirs = []
-            standalone_files = []
-            for filename in files_to_reinspect:
-                d = get_cabal_project_dir_of_file(filename)
-                if d is not None:
-                    cabal_dirs.append(d)
-                else:
-                    standalone_files.append(filename)
-            # Eliminate duplicate project directories:
-            cabal_dirs = list(set(cabal_dirs))
-            standalone_files = list(set(standalone_files))
-            for d in cabal_dirs:
-                self._refresh_all_module_info(d)
-            for f in standalone_files:
-                self._refresh_module_info(f)
-            time.sleep(AGENT_SLEEP_DURATION)
+            (filename, priority) = self.queue.get()
+            # Files, which are not open, are inspected when user doesn't type
+            if priority > INSPECT_OPEN:
+                activity_governor.wait_for_idle()
+            try:
+                self.configure_index()
+                self._inspect_file(filename, priority)
+            except Exception, e:
+                log('inspection of {0} failed: {1}'.format(filename, e))
+
+    def start_index_host(self):
+        "Run index in separate process with 'index_host_python' interpreter, if it is set"
+        python = get_setting_async('index_host_python')
+        if not python:
+            return
+        try:
+            autocompletion.index = IndexHostClient(python, self.on_index_host_exit)
+        except OSError, e:
+            log('index host can\'t be started, index runs in plugin: {0}'.format(e))
+
+    def on_index_host_exit(self):
+        "Switch to index in plugin process, projects are rescanned to fill it"
+        log('index host terminated, index runs in plugin')
+        autocompletion.index = create_local_index()
+        autocompletion.index_changed()
+        self.index_settings_version = None
+        with self.projects_lock:
+            self.project_files = {}
+
+    def configure_index(self):
+        "Configure index if settings changed"
+        version = get_settings_version()
+        if version == self.index_settings_version:
+            return
+        self.index_settings_version = version
+        index = autocompletion.index
+        if isinstance(index, IndexHostClient):
+            index.configure_runner(get_tool_environment().env, get_setting_async('process_timeouts', {}))
+        index.configure(MODULE_INSPECTOR_EXE_PATH, OUTPUT_PATH, try_attach_sandbox([]))
 
     def mark_all_files(self, window):
-        folder_files = []
-        for folder in window.folders():
-            folder_files.extend(list_files_in_dir_recursively(folder))
-        with self.dirty_files_lock:
-            self.dirty_files.extend(folder_files)
+        "Queue files of all folders, open files and active file first"
+        for w in sublime.windows():
+            for folder in w.folders():
+                for filename in list_files_in_dir_recursively(folder):
+                    if filename.endswith('.hs'):
+                        self.queue.put(filename, INSPECT_REST)
+            for view in w.views():
+                if view.file_name():
+                    self.queue.put(view.file_name(), INSPECT_OPEN)
+        active_view = window.active_view()
+        if active_view and active_view.file_name():
+            self.queue.put(active_view.file_name(), INSPECT_ACTIVE)
 
     def show_errors(self, window, error_text):
         sublime.set_timeout(lambda: sublime.status_message('Compiling Haskell ModuleInspector' + u" \u2717"), 0)
         sublime.set_timeout(lambda: output_error(window, error_text), 0)
 
-    def mark_file_dirty(self, filename):
-        "Report that a file should be reinspected."
-        with self.dirty_files_lock:
-            self.dirty_files.append(filename)
+    def on_files_changed(self, changes):
+        """
+        Queue files changed outside of editor, changes is a dictionary: path => kind.
+        Project is rescanned if its cabal file changed or changes were lost.
+        """
+        log('{0} files changed'.format(len(changes)))
+        metrics.count('external file changes', len(changes))
+        rescan_dirs = set()
+        with self.projects_lock:
+            for (path, kind) in changes.items():
+                if kind == OVERFLOW or path.endswith('.cabal'):
+                    rescan_dir = path if kind == OVERFLOW else os.path.dirname(path)
+                    if self.project_files.pop(rescan_dir, None) is not None:
+                        rescan_dirs.add(rescan_dir)
+                    continue
+                if not path.endswith('.hs') or 'dist/build/autogen' in path:
+                    continue
+                project_files = [fs for (d, fs) in self.project_files.items() if path.startswith(d + os.sep)]
+                if kind == DELETED:
+                    for fs in project_files:
+                        if path in fs:
+                            fs.remove(path)
+                else:
+                    for fs in project_files:
+                        if path not in fs:
+                            fs.append(path)
+                # Deleted files are removed from index on inspection
+                self.queue.put(path, INSPECT_REST)
+        for rescan_dir in rescan_dirs:
+            # Project directory can be removed too
+            if os.path.isdir(rescan_dir):
+                self._queue_project(rescan_dir)
 
-    def _refresh_all_module_info(self, cabal_dir):
-        "Rebuild module information for all files under the specified directory."
-        begin_time = time.clock()
+    def mark_file_dirty(self, filename):
+        "Report that a file should be reinspected, other files of its project are rescanned for changes too."
+        with self.projects_lock:
+            self.saved_files.add(filename)
+        self.queue.put(filename, INSPECT_ACTIVE)
+
+    def _inspect_file(self, filename, priority):
+        "Inspect file, queue files of its project, and its imports if file is open."
+        # File (or its whole directory) is deleted, e.g. by branch switch
+        if not os.path.exists(filename):
+            autocompletion.index.forget(filename)
+            autocompletion.index_changed()
+            return
+        cabal_dir = get_cabal_project_dir_of_file(filename)
+        with self.projects_lock:
+            if filename in self.saved_files:
+                self.saved_files.discard(filename)
+                self.project_files.pop(cabal_dir, None)
+        if cabal_dir is not None:
+            self._queue_project(cabal_dir)
+        self._refresh_module_info(filename)
+        if priority <= INSPECT_OPEN and cabal_dir is not None:
+            self._queue_imports(filename, cabal_dir)
+
+    def _queue_project(self, cabal_dir):
+        "Refresh project information and queue all its files, if it is not queued yet."
+        with self.projects_lock:
+            if cabal_dir in self.project_files:
+                return
         log('reinspecting project ({0})'.format(cabal_dir))
-        # Process all files within the Cabal project:
         # TODO: Only process files within the .cabal file's "src" directory.
         (project_name, cabal_file) = get_cabal_in_dir(cabal_dir)
         # set project and read cabal
@@ -462,10 +705,26 @@ class InspectorAgent(threading.Thread):
 
         files_in_dir = list_files_in_dir_recursively(cabal_dir)
         haskell_source_files = [x for x in files_in_dir if x.endswith('.hs') and ('dist/build/autogen' not in x)]
+        with self.projects_lock:
+            self.project_files[cabal_dir] = haskell_source_files
+        if self.file_watcher:
+            self.file_watcher.watch(cabal_dir)
+        # Unchanged files are skipped on inspection
         for filename in haskell_source_files:
-            self._refresh_module_info(filename)
-        end_time = time.clock()
-        log('total inspection time: {0} seconds'.format(end_time - begin_time))
+            self.queue.put(filename, INSPECT_REST)
+
+    def _queue_imports(self, filename, cabal_dir):
+        "Queue project files imported by file."
+        info = autocompletion.index.file_info(filename) or {}
+        imports = [i['importName'] for i in info.get('imports', []) if 'importName' in i]
+        with self.projects_lock:
+            project_files = self.project_files.get(cabal_dir, [])
+        for module_name in imports:
+            # Module A.B.C is in file A/B/C.hs under some source directory
+            suffix = os.sep + os.path.join(*module_name.split('.')) + '.hs'
+            for f in project_files:
+                if f.endswith(suffix):
+                    self.queue.put(f, INSPECT_IMPORTS)
 
     def _refresh_project_info(self, cabal_dir, project_name, cabal_file):
         exit_code, out, err = call_and_wait(
@@ -485,54 +744,17 @@ class InspectorAgent(threading.Thread):
     def _refresh_module_info(self, filename):
         "Rebuild module information for the specified file."
         # TODO: Only do this within Haskell files in Cabal projects.
-        # TODO: Skip this file if it hasn't changed since it was last inspected.
         # TODO: Currently the ModuleInspector only delivers top-level functions
         #       with hand-written type signatures. This code should make that clear.
-        # If the file hasn't changed since it was last inspected, do nothing:
+        # Index skips file if it hasn't changed since it was last inspected
         if not filename.endswith('.hs'):
             return
-
-        modification_time = os.stat(filename).st_mtime
-        if CHECK_MTIME:
-            inspection_time = self._get_inspection_time_of_file(filename)
-            if modification_time <= inspection_time:
-                return
-        exit_code, stdout, stderr = call_and_wait(
-            [MODULE_INSPECTOR_EXE_PATH, filename])
-        # Update only when module is ok
-        if exit_code == 0:
-            new_info = json.loads(stdout)
-
-            if 'error' not in new_info:
-                # Load standard modules
-                if 'imports' in new_info:
-                    for mi in new_info['imports']:
-                        if 'importName' in mi:
-                            self._load_standard_module(mi['importName'])
-
-                # Remember when this info was collected.
-                new_info['inspectedAt'] = modification_time
-                # Dump the currently-known module info to disk:
-                formatted_json = json.dumps(autocompletion.info, indent=2)
-                with open(OUTPUT_PATH, 'w') as f:
-                    f.write(formatted_json)
-                with autocompletion.info_lock:
-                    autocompletion.info[filename] = new_info
-
-    def _load_standard_module(self, module_name):
-        if module_name not in autocompletion.std_info:
-            module_contents = call_ghcmod_and_wait(['browse', module_name]).splitlines()
-            with autocompletion.std_info_lock:
-                autocompletion.std_info[module_name] = module_contents
-
-    def _get_inspection_time_of_file(self, filename):
-        """Return the time that a file was last inspected.
-        Return zero if it has never been inspected."""
-        with autocompletion.info_lock:
-            try:
-                return autocompletion.info[filename]['inspectedAt']
-            except KeyError:
-                return 0.0
+        begin_time = time.time()
+        if autocompletion.index.inspect(filename):
+            metrics.record('inspection', time.time() - begin_time)
+            autocompletion.index_changed()
+        else:
+            metrics.count('inspections skipped, file unchanged')
 
 def list_files_in_dir_recursively(base_dir):
     """Return a list of a all files in a directory, recursively.
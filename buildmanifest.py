@@ -0,0 +1,123 @@
+import hashlib
+import os
+import threading
+
+from sublime_haskell_common import get_file_hash, log
+
+# Changes of files with these extensions make previous build results stale
+SOURCE_EXTENSIONS = ['.hs', '.lhs', '.hsc', '.chs', '.c', '.h']
+
+# These directories are not scanned for sources
+IGNORED_DIRS = ['dist', 'cabal-dev', '.git', '.hg', '.svn']
+
+# Build state of projects (dictionary: cabal project dir => state)
+# state is:
+#   configured - key of last successful configure or None, key is (configure command, hash of .cabal)
+#   builds - last results of build commands (dictionary: build command => result)
+#     result is (manifest, configured, exit_code, stderr)
+project_states_lock = threading.Lock()
+project_states = {}
+
+def get_project_state(cabal_project_dir):
+    with project_states_lock:
+        if cabal_project_dir not in project_states:
+            project_states[cabal_project_dir] = { 'configured': None, 'builds': {} }
+        return project_states[cabal_project_dir]
+
+def compute_manifest(cabal_project_dir):
+    """
+    Return manifest of project: dictionary with keys
+      cabal - hash of .cabal files
+      sources - hash of all source files
+    """
+    cabal_hashes = []
+    source_hashes = []
+    for dirname, dirnames, filenames in os.walk(cabal_project_dir):
+        # Don't descend into build output and VCS directories
+        dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS]
+        for filename in filenames:
+            full_path = os.path.join(dirname, filename)
+            rel_path = os.path.relpath(full_path, cabal_project_dir)
+            ext = os.path.splitext(filename)[1]
+            try:
+                if ext == '.cabal' and dirname == cabal_project_dir:
+                    cabal_hashes.append((rel_path, get_file_hash(full_path)))
+                elif ext in SOURCE_EXTENSIONS:
+                    source_hashes.append((rel_path, get_file_hash(full_path)))
+            except (IOError, OSError):
+                # Deleted while walking or dangling symlink (e.g. editor lock file .#Main.hs)
+                pass
+
+    def hash_list(hashes):
+        return hashlib.md5(repr(sorted(hashes))).hexdigest()
+
+    return {
+        'cabal': hash_list(cabal_hashes),
+        'sources': hash_list(source_hashes) }
+
+def cabal_subcommand(cmd):
+    "Return cabal command of ['cabal', 'build', ...] or ['cabal-dev', 'build', '-s', sandbox]"
+    return cmd[1] if len(cmd) > 1 else None
+
+class BuildPlan(object):
+    """
+    Decides which commands of build chain really need to run.
+    'build' is skipped (its last result is replayed) if sources, .cabal and configuration didn't change.
+    In chains like clean-configure-build (rebuild) 'configure' runs only if .cabal or
+    sandbox changed, and 'clean' only if there was another configuration before.
+    """
+    def __init__(self, cabal_project_dir, cmds):
+        self.cabal_project_dir = cabal_project_dir
+        self.state = get_project_state(cabal_project_dir)
+        self.manifest = compute_manifest(cabal_project_dir)
+        self.cmds = []
+        # Result (exit_code, stderr) to show instead of running build
+        self.replay = None
+
+        subcommands = [cabal_subcommand(cmd) for cmd in cmds]
+        # Clean and configure in one chain with build, this is rebuild
+        smart = 'build' in subcommands and 'configure' in subcommands
+
+        configured = self.state['configured']
+        need_configure = True
+        need_clean = True
+        if smart:
+            configure_cmd = cmds[subcommands.index('configure')]
+            need_configure = (
+                configured != self.configure_key(configure_cmd) or
+                not os.path.exists(os.path.join(cabal_project_dir, 'dist', 'setup-config')))
+            need_clean = need_configure and configured is not None
+
+        for cmd, subcommand in zip(cmds, subcommands):
+            if smart and subcommand == 'clean' and not need_clean:
+                continue
+            if smart and subcommand == 'configure' and not need_configure:
+                continue
+            self.cmds.append(cmd)
+
+        # Skip build if it is the only command left and nothing changed since its last run
+        if len(self.cmds) == 1 and cabal_subcommand(self.cmds[0]) == 'build':
+            last = self.state['builds'].get(tuple(self.cmds[0]))
+            if last and last[0] == self.manifest and last[1] == configured:
+                log('nothing changed in {0}, replaying last build result'.format(cabal_project_dir))
+                self.cmds = []
+                self.replay = (last[2], last[3])
+
+    def configure_key(self, cmd):
+        return (tuple(cmd), self.manifest['cabal'])
+
+    def record(self, cmd, exit_code, stderr):
+        "Remember result of command"
+        subcommand = cabal_subcommand(cmd)
+        if subcommand == 'clean':
+            self.state['configured'] = None
+            self.state['builds'] = {}
+        elif subcommand == 'configure':
+            self.state['configured'] = self.configure_key(cmd) if exit_code == 0 else None
+            self.state['builds'] = {}
+        elif subcommand == 'build':
+            self.state['builds'][tuple(cmd)] = (self.manifest, self.state['configured'], exit_code, stderr)
+        elif subcommand == 'install':
+            # Install configures and builds on its own
+            self.state['configured'] = None
+            self.state['builds'] = {}
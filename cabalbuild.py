@@ -1,19 +1,31 @@
+import codecs
 import fnmatch
 import os
+import Queue
 import re
+import shlex
 import sublime
 import sublime_plugin
 import subprocess
+import threading
 from threading import Thread
 import time
 
-from sublime_haskell_common import get_cabal_project_dir_of_view, get_cabal_project_dir_and_name_of_view, call_and_wait, log, are_paths_equal, get_setting, get_setting_async, set_setting, save_settings, is_enabled_haskell_command, get_haskell_command_window_view_file_project, SublimeHaskellBaseCommand
-from parseoutput import run_chain_build_thread
+from sublime_haskell_common import get_cabal_project_dir_of_view, get_cabal_project_dir_and_name_of_view, process_executor, ProcessHandle, PRIORITY_INTERACTIVE, log, are_paths_equal, get_setting, get_setting_async, set_setting, save_settings, is_enabled_haskell_command, get_haskell_command_window_view_file_project, SublimeHaskellBaseCommand, open_output_log
+from parseoutput import run_chain_build_thread, get_project_build, parse_output_messages, format_output_messages, show_output_result_text, diagnostics, show_diagnostics, hide_output as hide_error_output
+from buildmanifest import IGNORED_DIRS
 from autobuild import attach_sandbox
 from autocomplete import autocompletion
 
 OUTPUT_PANEL_NAME = "haskell_run_output"
 
+# Package name field of .cabal file
+CABAL_NAME_RE = re.compile(r'^name\s*:\s*(\S+)', re.IGNORECASE | re.MULTILINE)
+# build-depends field of .cabal file with its continuation lines (indented deeper than field)
+CABAL_BUILD_DEPENDS_RE = re.compile(r'^([ \t]*)build-depends\s*:(.*(?:\n\1[ \t]+\S.*)*)', re.IGNORECASE | re.MULTILINE)
+# Package name in build-depends item, e.g. 'base >= 4 && < 5'
+CABAL_DEPENDENCY_RE = re.compile(r'\s*([A-Za-z0-9][A-Za-z0-9\-]*)')
+
 cabal_tool = {
     True: { 'command': 'cabal-dev', 'message': 'Cabal-Dev', 'extra': lambda cmd: attach_sandbox(cmd) },
     False: { 'command': 'cabal', 'message': 'Cabal', 'extra': lambda cmd: cmd }
@@ -23,11 +35,18 @@ cabal_command = {
     'clean': { 'args': ['clean'], 'message': 'Cleaning' },
     'configure': { 'args': ['configure'], 'message': 'Configure' },
     'build': { 'args': ['build'], 'message': 'Building' },
+    # Typecheck only, ghc options are taken from 'check_ghc_options' setting
+    'check': { 'args': ['build'], 'message': 'Typechecking', 'check': True },
     'rebuild': { 'args': ['clean', 'configure', 'build'], 'message': 'Rebuilding' },
     'install': { 'args': ['install'], 'message': 'Installing' }
 }
 
 def run_build(command, use_cabal_dev = None):
+    msg, cmds = get_build_commands(command, use_cabal_dev)
+    run_build_commands_with(msg, cmds, cabal_command[command].get('check', False))
+
+def get_build_commands(command, use_cabal_dev = None):
+    """Returns message lambda (project name => status message) and commands to run"""
     # Run cabal or cabal-dev
     if use_cabal_dev == None:
         use_cabal_dev = get_setting_async('use_cabal_dev')
@@ -45,10 +64,14 @@ def run_build(command, use_cabal_dev = None):
     tool_name = tool['command']
     # Tool arguments (commands): build, clean, etc.
     tool_args = config['args']
+    # Extra arguments for typecheck only build
+    check_args = []
+    if config.get('check'):
+        check_args = ['--ghc-options=' + ' '.join(get_setting('check_ghc_options', ['-fno-code']))]
 
-    run_build_commands_with(
+    return (
         lambda name: tool_title + ': ' + action_title + ' ' + name,
-        [extra_args([tool_name, arg]) for arg in tool_args])
+        [extra_args([tool_name, arg]) + check_args for arg in tool_args])
 
 class SublimeHaskellSwitchCabalDev(sublime_plugin.WindowCommand):
     def run(self):
@@ -117,6 +140,10 @@ class SublimeHaskellBuild(SublimeHaskellBaseCommand):
     def run(self):
         run_build('build')
 
+class SublimeHaskellTypecheck(SublimeHaskellBaseCommand):
+    def run(self):
+        run_build('check')
+
 class SublimeHaskellRebuild(SublimeHaskellBaseCommand):
     def run(self):
         run_build('rebuild')
@@ -162,45 +189,154 @@ class SublimeHaskellRun(SublimeHaskellBaseCommand):
         base_dir = selected['dir']
         bin_file = os.path.join(selected['dir'], 'dist', 'build', name, name)
 
-        hide_output(self.window)
+        self.window.show_input_panel(
+            'Arguments for ' + name + ':',
+            run_arguments.get(bin_file, ''),
+            lambda args: self.run_executable(name, bin_file, base_dir, args),
+            None,
+            None)
+
+    def run_executable(self, name, bin_file, base_dir, args):
+        run_arguments[bin_file] = args
+        try:
+            # shlex doesn't support unicode in Python 2
+            arg_list = [a.decode('utf-8') for a in shlex.split(args.encode('utf-8'))]
+        except ValueError, e:
+            sublime.status_message('SublimeHaskell: Invalid arguments: {0}'.format(e))
+            return
 
         sublime.status_message('SublimeHaskell: Running ' + name + "...")
 
-        # Run in thread
-        thread = Thread(
-            target=run_binary,
-            args=(name, bin_file, base_dir))
-        thread.start()
+        global running_binary
+        if running_binary:
+            running_binary.stop()
+        running_binary = RunningBinary(self.window, name, [bin_file] + arg_list, base_dir)
+        running_binary.start()
+
+# Last arguments of executables (dictionary: executable path => arguments string)
+run_arguments = {}
+
+# Executable run by SublimeHaskellRun, new run stops previous one
+running_binary = None
+
+class RunningBinary(object):
+    """
+    Runs executable and streams its stdout and stderr to output panel as they arrive.
+    No more than 'output_panel_max_size' characters are shown, full output is saved to log.
+    """
+    def __init__(self, window, name, command, base_dir):
+        self.name = name
+        self.command = command
+        self.base_dir = base_dir
+        self.handle = ProcessHandle()
+        self.max_size = get_setting('output_panel_max_size', 500000)
+        self.lock = threading.Lock()
+        # Output not yet written to panel
+        self.pending = []
+        # Is flush to panel scheduled
+        self.flush_scheduled = False
+        self.shown_size = 0
+        self.finished = False
+
+        # Get output panel once, getting it again clears it
+        self.output_view = window.get_output_panel(OUTPUT_PANEL_NAME)
+        self.output_view.settings().set('result_base_dir', base_dir)
+        window.run_command('show_panel', {'panel': 'output.' + OUTPUT_PANEL_NAME})
+
+    def start(self):
+        Thread(target=self.run).start()
+
+    def stop(self):
+        self.handle.cancel()
+
+    def is_running(self):
+        return not self.finished and not self.handle.cancelled
 
-def run_binary(name, bin_file, base_dir):
-    exit_code, out, err = call_and_wait(bin_file, cwd = base_dir)
-    window = sublime.active_window()
-    if not window:
-        return
-    if exit_code == 0:
-        sublime.set_timeout(lambda: sublime.status_message('SublimeHaskell: Running ' + name + u" \u2714"), 0)
-        sublime.set_timeout(lambda: write_output(window, out, base_dir), 0)
-    else:
-        sublime.set_timeout(lambda: sublime.status_message('SublimeHaskell: Running ' + name + u" \u2717"), 0)
-        sublime.set_timeout(lambda: write_output(window, err, base_dir), 0)
-
-def write_output(window, text, base_dir):
-    "Write text to Sublime's output panel."
-    output_view = window.get_output_panel(OUTPUT_PANEL_NAME)
-    output_view.set_read_only(False)
-    # Configure Sublime's error message parsing:
-    output_view.settings().set("result_base_dir", base_dir)
-    # Write to the output buffer:
-    edit = output_view.begin_edit()
-    #output_view.insert(edit, 0, text)
-    output_view.insert(edit, 0, text)
-    output_view.end_edit(edit)
-    # Set the selection to the beginning of the view so that "next result" works:
-    output_view.sel().clear()
-    output_view.sel().add(sublime.Region(0))
-    output_view.set_read_only(True)
-    # Show the results panel:
-    window.run_command('show_panel', {'panel': 'output.' + OUTPUT_PANEL_NAME})
+    def run(self):
+        log_file = open_output_log(OUTPUT_PANEL_NAME)
+        try:
+            try:
+                # stderr is merged to stdout to keep them in order
+                process = process_executor.start(self.command, PRIORITY_INTERACTIVE, self.handle, cwd = self.base_dir, stderr = subprocess.STDOUT)
+            except OSError, e:
+                self.append(u'Failed to run {0}: {1}\n'.format(self.name, e))
+                self.finish(None)
+                return
+            if process is None:
+                # Stopped before start
+                self.finish(None)
+                return
+            try:
+                process.stdin.close()
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                while True:
+                    data = os.read(process.stdout.fileno(), 4096)
+                    if not data:
+                        break
+                    text = decoder.decode(data)
+                    log_file.write(text)
+                    self.append(text)
+                exit_code = process.wait()
+            finally:
+                process_executor.release(process)
+            self.finish(exit_code)
+        finally:
+            log_file.close()
+
+    def append(self, text):
+        "Queue text to be written to panel, called from worker thread"
+        with self.lock:
+            if self.shown_size >= self.max_size:
+                return
+            if self.shown_size + len(text) > self.max_size:
+                text = text[0:self.max_size - self.shown_size] + u'\n\n... output is too long, run "SublimeHaskell: Open Full Log" to see the whole output\n'
+            self.shown_size += len(text)
+            self.pending.append(text)
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        # Coalesce output arrived in the meantime into one edit
+        sublime.set_timeout(self.flush, 50)
+
+    def flush(self):
+        with self.lock:
+            text = u''.join(self.pending)
+            self.pending = []
+            self.flush_scheduled = False
+        # Panel is reused by newer run
+        if self is not running_binary:
+            return
+        self.output_view.set_read_only(False)
+        edit = self.output_view.begin_edit()
+        self.output_view.insert(edit, self.output_view.size(), text)
+        self.output_view.end_edit(edit)
+        self.output_view.set_read_only(True)
+
+    def finish(self, exit_code):
+        self.finished = True
+        if self.handle.cancelled:
+            footer = u'[Stopped]'
+            status = u'SublimeHaskell: {0} stopped'.format(self.name)
+        elif exit_code is None:
+            footer = u'[Failed]'
+            status = u'SublimeHaskell: Running {0} \u2717'.format(self.name)
+        else:
+            footer = u'[Finished with exit code {0}]'.format(exit_code)
+            status = u'SublimeHaskell: Running {0} {1}'.format(self.name, u'\u2714' if exit_code == 0 else u'\u2717')
+        # Footer is shown even if output is truncated
+        with self.lock:
+            self.max_size += len(footer) + 2
+        self.append(u'\n' + footer + u'\n')
+        sublime.set_timeout(lambda: sublime.status_message(status), 0)
+
+class SublimeHaskellStopRun(sublime_plugin.WindowCommand):
+    "Stop executable run by SublimeHaskellRun"
+    def run(self):
+        if running_binary:
+            running_binary.stop()
+
+    def is_enabled(self):
+        return running_binary is not None and running_binary.is_running()
 
 def hide_output(window):
     window.run_command('hide_panel', {'panel': 'output.' + OUTPUT_PANEL_NAME})
@@ -249,7 +385,7 @@ class SublimeHaskellCabalDevInstall(SublimeHaskellBaseCommand):
     def run(self):
         run_build('install', True)
 
-def run_build_commands_with(msg, cmds):
+def run_build_commands_with(msg, cmds, typecheck_only = False):
     """Run general build commands"""
     window, view, file_shown_in_view = get_haskell_command_window_view_file_project()
     if not file_shown_in_view:
@@ -261,8 +397,134 @@ def run_build_commands_with(msg, cmds):
     if not cabal_project_dir:
         return
 
-    run_chain_build_thread(view, cabal_project_dir, msg(cabal_project_name), cmds)
+    run_chain_build_thread(view, cabal_project_dir, msg(cabal_project_name), cmds, typecheck_only)
 
 def run_build_command_with(msg, cmd):
     """Run one command"""
     run_build_commands_with(msg, [cmd])
+
+# Workspace build
+
+class SublimeHaskellBuildWorkspace(sublime_plugin.WindowCommand):
+    def run(self):
+        msg, cmds = get_build_commands('build')
+        jobs = max(1, get_setting('workspace_build_jobs', 2))
+        view = self.window.active_view()
+        folders = self.window.folders()
+
+        sublime.status_message('SublimeHaskell: Building workspace...')
+        hide_error_output(view)
+
+        thread = Thread(
+            target=build_workspace,
+            args=(view, folders, msg('workspace'), cmds, jobs))
+        thread.start()
+
+    def is_enabled(self):
+        return len(self.window.folders()) > 0 and self.window.active_view() is not None
+
+def find_cabal_projects(folders):
+    """
+    Find cabal projects in folders
+    Returns list of projects, where project is:
+      dir - project dir
+      name - package name
+      depends - names of packages in build-depends
+    """
+    projects = {}
+    for folder in folders:
+        for dirname, dirnames, filenames in os.walk(folder):
+            dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS]
+            cabal_files = [f for f in filenames if f.endswith('.cabal')]
+            if not cabal_files or dirname in projects:
+                continue
+            with open(os.path.join(dirname, cabal_files[0])) as f:
+                contents = f.read()
+            name_match = CABAL_NAME_RE.search(contents)
+            depends = set()
+            for m in CABAL_BUILD_DEPENDS_RE.finditer(contents):
+                for item in m.group(2).split(','):
+                    dep = CABAL_DEPENDENCY_RE.match(item)
+                    if dep:
+                        depends.add(dep.group(1))
+            projects[dirname] = {
+                'dir': dirname,
+                'name': name_match.group(1) if name_match else os.path.splitext(cabal_files[0])[0],
+                'depends': depends }
+    return projects.values()
+
+def build_workspace(view, folders, msg, cmds, jobs):
+    """
+    Build all cabal projects in folders, dependencies first.
+    Projects, which don't depend on each other, are built in parallel, but no more than jobs at once.
+    Projects, which dependencies failed to build, are skipped.
+    Messages of all projects are shown together.
+    """
+    projects = {}
+    for p in find_cabal_projects(folders):
+        projects[p['name']] = p
+    # Dependencies within workspace
+    depends = {}
+    for name, p in projects.items():
+        depends[name] = [d for d in p['depends'] if d in projects and d != name]
+
+    order = sorted(projects.keys())
+    # Project name => was build successful
+    done = {}
+    started = set()
+    running = 0
+    results = Queue.Queue()
+
+    messages = []
+    failed_outputs = []
+    # Directories of projects, which builds finished
+    built_dirs = []
+
+    while len(done) < len(projects):
+        ready = [n for n in order if n not in started and all(d in done for d in depends[n])]
+        if not ready and running == 0:
+            # Dependency cycle, build the rest anyway
+            ready = [n for n in order if n not in started]
+
+        for name in ready:
+            if running >= jobs:
+                break
+            started.add(name)
+            failed_deps = [d for d in depends[name] if d in done and not done[d]]
+            if failed_deps:
+                done[name] = False
+                failed_outputs.append(u'Skipped {0}: dependencies failed to build: {1}'.format(name, ', '.join(failed_deps)))
+                continue
+            running += 1
+            get_project_build(projects[name]['dir']).schedule(
+                cmds,
+                lambda exit_code, stderr, name = name: results.put((name, exit_code, stderr)),
+                lambda name = name: results.put((name, None, None)))
+
+        if running == 0:
+            continue
+
+        name, exit_code, stderr = results.get()
+        running -= 1
+        done[name] = exit_code == 0
+
+        if exit_code is None:
+            failed_outputs.append(u'Build of {0} was superseded'.format(name))
+        else:
+            built_dirs.append(projects[name]['dir'])
+            stderr = stderr.decode('utf-8')
+            parsed = parse_output_messages(projects[name]['dir'], stderr)
+            messages.extend(parsed)
+            if exit_code != 0 and not parsed:
+                failed_outputs.append(u'{0}:\n{1}'.format(name, stderr))
+
+        status = u'{0}: {1}/{2} {3}'.format(msg, len(done), len(projects), name)
+        sublime.set_timeout(lambda: sublime.status_message(status), 0)
+
+    output_text = u'\n\n'.join(failed_outputs + ([format_output_messages(messages)] if messages else []))
+    exit_code = 0 if all(done.values()) else 1
+
+    show_output_result_text(view, msg, output_text, exit_code, folders[0])
+
+    # Messages of projects, which were not built, stay
+    show_diagnostics(diagnostics.update('build', messages, directories = built_dirs))
@@ -0,0 +1,331 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import threading
+import time
+
+from sublime_haskell_common import log
+from buildmanifest import IGNORED_DIRS
+
+# Kinds of changes
+CREATED = 'created'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+RENAMED = 'renamed'
+# Events were lost, whole root must be rescanned
+OVERFLOW = 'overflow'
+
+# Batch is reported when there are no new changes for this time (seconds)
+BATCH_QUIET_PERIOD = 0.3
+# but no later than this time after first change of batch (seconds)
+BATCH_MAX_DELAY = 10.0
+
+# inotify constants, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+# struct inotify_event header: wd, mask, cookie, len
+INOTIFY_EVENT = 'iIII'
+INOTIFY_EVENT_SIZE = struct.calcsize(INOTIFY_EVENT)
+
+def list_watched_dirs(root):
+    "Returns all directories under root, except build output and VCS ones"
+    dirs = []
+    for dirname, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS]
+        dirs.append(dirname)
+    return dirs
+
+class ChangeBatcher(object):
+    """
+    Collects changes and reports them in batches, so that many changes at once
+    (e.g. branch switch) are handled together.
+    on_batch(changes) is called from batcher thread, changes is a dictionary: path => kind
+    """
+    def __init__(self, on_batch):
+        self.on_batch = on_batch
+        self.condition = threading.Condition()
+        self.changes = {}
+        # Time of first and last change of current batch
+        self.first_change = None
+        self.last_change = None
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, path, kind):
+        with self.condition:
+            previous = self.changes.get(path)
+            # File created in this batch stays created while modified
+            if previous in [CREATED, RENAMED] and kind == MODIFIED:
+                kind = previous
+            self.changes[path] = kind
+            now = time.time()
+            if self.first_change is None:
+                self.first_change = now
+            self.last_change = now
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.changes:
+                    self.condition.wait()
+                now = time.time()
+                deadline = min(self.last_change + BATCH_QUIET_PERIOD, self.first_change + BATCH_MAX_DELAY)
+                if now < deadline:
+                    self.condition.wait(deadline - now)
+                    continue
+                changes = self.changes
+                self.changes = {}
+                self.first_change = None
+                self.last_change = None
+            try:
+                self.on_batch(changes)
+            except Exception, e:
+                log('handling file changes failed: {0}'.format(e))
+
+class InotifyWatcher(object):
+    "Watches directory trees with inotify, raises OSError if inotify is not available"
+    def __init__(self, batcher):
+        self.batcher = batcher
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.lock = threading.Lock()
+        # Watched directories (dictionary: watch descriptor => directory)
+        self.dirs = {}
+        # Files of watched directories, to report them when directory is removed (dictionary: directory => set of names)
+        self.files = {}
+        # Roots of watched trees
+        self.roots = []
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, root):
+        with self.lock:
+            self.roots.append(root)
+        for d in list_watched_dirs(root):
+            self.add_dir(d)
+
+    def add_dir(self, directory):
+        "Watch directory, returns paths of its files"
+        native_directory = directory.encode('utf-8') if isinstance(directory, unicode) else directory
+        wd = self.libc.inotify_add_watch(self.fd, native_directory, WATCH_MASK)
+        if wd < 0:
+            log('can\'t watch {0}: {1}'.format(directory, os.strerror(ctypes.get_errno())))
+            return []
+        # Files, created after this, are reported by events
+        try:
+            names = [n for n in os.listdir(directory) if not os.path.isdir(os.path.join(directory, n))]
+        except OSError:
+            # Directory is removed, its watch is removed too
+            names = []
+        with self.lock:
+            self.dirs[wd] = directory
+            self.files.setdefault(directory, set()).update(names)
+        return [os.path.join(directory, n) for n in names]
+
+    def remove_dir(self, path):
+        "Stop watching removed directory and its subdirectories, returns paths of their known files"
+        def is_under_path(directory):
+            # Unicode and byte string paths of different trees can't be compared
+            return type(directory) is type(path) and (directory == path or directory.startswith(path + os.sep))
+
+        removed = []
+        with self.lock:
+            for (wd, directory) in list(self.dirs.items()):
+                if is_under_path(directory):
+                    del self.dirs[wd]
+                    # Moved directory is still watched by inotify
+                    self.libc.inotify_rm_watch(self.fd, wd)
+            for directory in list(self.files.keys()):
+                if is_under_path(directory):
+                    removed.extend([os.path.join(directory, n) for n in self.files.pop(directory)])
+        return removed
+
+    def run(self):
+        # Moved files (dictionary: cookie => old path)
+        moved_from = {}
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    log('reading inotify events failed: {0}'.format(e))
+                    time.sleep(1)
+                continue
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = struct.unpack_from(INOTIFY_EVENT, data, offset)
+                name = data[offset + INOTIFY_EVENT_SIZE:offset + INOTIFY_EVENT_SIZE + length].rstrip('\0')
+                offset += INOTIFY_EVENT_SIZE + length
+                # Directory can be removed while event is handled, watching must go on anyway
+                try:
+                    self.on_event(wd, mask, cookie, name, moved_from)
+                except Exception, e:
+                    log('handling inotify event for {0} failed: {1}'.format(repr(name), e))
+
+    def on_event(self, wd, mask, cookie, name, moved_from):
+        if mask & IN_Q_OVERFLOW:
+            with self.lock:
+                roots = list(self.roots)
+            for root in roots:
+                self.batcher.add(root, OVERFLOW)
+            return
+        with self.lock:
+            directory = self.dirs.get(wd)
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+        if directory is None or not name:
+            return
+        # Names are joined with directory of the same string type
+        if isinstance(directory, unicode):
+            name = name.decode('utf-8', 'replace')
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and name not in IGNORED_DIRS:
+                # New directory: watch it and report its files, which could be created before watch was added
+                for d in list_watched_dirs(path):
+                    for f in self.add_dir(d):
+                        self.batcher.add(f, CREATED)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                # Files of moved directory are not reported one by one
+                for f in self.remove_dir(path):
+                    self.batcher.add(f, DELETED)
+            return
+        with self.lock:
+            names = self.files.setdefault(directory, set())
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                names.discard(name)
+            elif mask & (IN_MOVED_TO | IN_CREATE):
+                names.add(name)
+        if mask & IN_MOVED_FROM:
+            moved_from[cookie] = path
+            self.batcher.add(path, DELETED)
+        elif mask & IN_MOVED_TO:
+            self.batcher.add(path, RENAMED if moved_from.pop(cookie, None) else CREATED)
+        elif mask & IN_CREATE:
+            self.batcher.add(path, CREATED)
+        elif mask & IN_DELETE:
+            self.batcher.add(path, DELETED)
+        elif mask & (IN_CLOSE_WRITE | IN_MODIFY):
+            self.batcher.add(path, MODIFIED)
+
+class PollingWatcher(object):
+    """
+    Watches directory trees by polling every 'interval' seconds.
+    Every poll stats each watched directory and file, so cost grows with number of files.
+    Directories are listed again only if their modification time changed (file created or deleted),
+    changes of file contents are found by modification time of file.
+    """
+    def __init__(self, batcher, interval):
+        self.batcher = batcher
+        self.interval = interval
+        self.lock = threading.Lock()
+        # Modification times of directories and files (dictionary: path => mtime)
+        self.dirs = {}
+        self.files = {}
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, root):
+        for d in list_watched_dirs(root):
+            self.scan_dir(d, False)
+
+    def scan_dir(self, directory, report):
+        "Remember directory and its files, report new files if report is set"
+        try:
+            mtime = os.stat(directory).st_mtime
+            names = os.listdir(directory)
+        except OSError:
+            return
+        with self.lock:
+            self.dirs[directory] = mtime
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                if name not in IGNORED_DIRS and path not in self.dirs:
+                    self.scan_dir(path, report)
+                continue
+            with self.lock:
+                known = path in self.files
+                try:
+                    self.files[path] = os.stat(path).st_mtime
+                except OSError:
+                    continue
+            if report and not known:
+                self.batcher.add(path, CREATED)
+
+    def poll(self):
+        with self.lock:
+            dirs = list(self.dirs.items())
+            files = list(self.files.items())
+        for (directory, mtime) in dirs:
+            try:
+                changed = os.stat(directory).st_mtime != mtime
+            except OSError:
+                with self.lock:
+                    self.dirs.pop(directory, None)
+                continue
+            if changed:
+                self.scan_dir(directory, True)
+        for (path, mtime) in files:
+            try:
+                new_mtime = os.stat(path).st_mtime
+            except OSError:
+                with self.lock:
+                    self.files.pop(path, None)
+                self.batcher.add(path, DELETED)
+                continue
+            if new_mtime != mtime:
+                with self.lock:
+                    self.files[path] = new_mtime
+                self.batcher.add(path, MODIFIED)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+class FileWatcher(object):
+    """
+    Watches project roots for changes made outside of editor (e.g. branch switch, code generation).
+    Uses inotify where available, polling otherwise.
+    on_batch(changes) is called with coalesced changes, dictionary: path => kind
+    """
+    def __init__(self, on_batch, poll_interval):
+        self.batcher = ChangeBatcher(on_batch)
+        self.roots = set()
+        self.lock = threading.Lock()
+        try:
+            self.watcher = InotifyWatcher(self.batcher)
+        except OSError, e:
+            log('inotify is not available, polling for file changes: {0}'.format(e))
+            self.watcher = PollingWatcher(self.batcher, poll_interval)
+
+    def watch(self, root):
+        "Start watching root, if it is not watched yet"
+        with self.lock:
+            if root in self.roots:
+                return
+            self.roots.add(root)
+        self.watcher.watch(root)
@@ -1,12 +1,18 @@
+import codecs
+import copy
+import hashlib
 import os
 import re
 import sublime
 import sublime_plugin
+import tempfile
+import threading
 from threading import Thread
 import time
 
-from sublime_haskell_common import log, is_enabled_haskell_command, get_haskell_command_window_view_file_project, try_attach_sandbox, call_ghcmod_and_wait
-from parseoutput import parse_output_messages, show_output_result_text, format_output_messages, mark_messages_in_views, parse_output_messages_and_show, hide_output, OutputMessage
+from sublime_haskell_common import log, is_enabled_haskell_command, get_haskell_command_window_view_file_project, try_attach_sandbox, call_ghcmod_and_wait, get_setting, process_executor, ProcessHandle, PRIORITY_CHECK, get_file_hash, get_cabal_project_dir_of_file, get_cabal_in_dir, get_settings_version, BoundedCache
+from parseoutput import parse_output_messages, show_output_result_text, format_output_messages, diagnostics, show_diagnostics, hide_output
+from autocomplete import autocompletion
 
 class SublimeHaskellGhcModCheck(sublime_plugin.WindowCommand):
     def run(self):
@@ -24,37 +30,56 @@ class SublimeHaskellGhcModLint(sublime_plugin.WindowCommand):
 
 class SublimeHaskellGhcModCheckAndLint(sublime_plugin.WindowCommand):
     def run(self):
-        def lint_as_hints(msgs):
-            for m in msgs:
-                if m[0] == 'lint':
-                    m[1].level = 'hint'
         run_ghcmods(['check', 'lint'], 'Checking and Lintind', lint_as_hints)
 
     def is_enabled(self):
         return is_enabled_haskell_command(False)
 
-def run_ghcmods(cmds, msg, alter_messages_cb = None):
+def lint_as_hints(msgs):
+    for m in msgs:
+        if m[0] == 'lint':
+            m[1].level = 'hint'
+
+def run_ghcmods(cmds, msg, alter_messages_cb = None, filenames = None, view = None):
     """
     Run several ghcmod commands, concats result messages with callback
     and show output.
     alter_messages_cb accepts dictionary (cmd => list of output messages)
+    filenames - files to check, file of active view by default
+    view - view to show output for, active view by default
     """
-    window, view, file_shown_in_view = get_haskell_command_window_view_file_project()
-    if not file_shown_in_view:
-        return
+    window, active_view, file_shown_in_view = get_haskell_command_window_view_file_project()
+    if view is None:
+        view = active_view
+    if filenames is None:
+        if not file_shown_in_view:
+            return
+        filenames = [file_shown_in_view]
 
-    file_dir, file_name = os.path.split(file_shown_in_view)
+    if len(filenames) == 1:
+        file_dir, file_name = os.path.split(filenames[0])
+        names = [file_name]
+    else:
+        # Several files are checked from project directory
+        file_dir = get_cabal_project_dir_of_file(filenames[0]) or os.path.dirname(filenames[0])
+        names = [os.path.relpath(f, file_dir) for f in filenames]
+        file_name = '{0} files'.format(len(names))
 
     ghc_mod_args = []
     for cmd in cmds:
-        ghc_mod_args.append((cmd, [cmd, file_name]))
+        if cmd == 'lint':
+            # ghc-mod lints one file at once
+            for name in names:
+                ghc_mod_args.append((cmd, [cmd, name]))
+        else:
+            ghc_mod_args.append((cmd, [cmd] + names))
 
     def show_current_file_first_and_alter(msgs):
         if alter_messages_cb:
             alter_messages_cb(msgs)
         def compare(l, r):
-            # sort by file equality to file_name
-            res = cmp(l[1].filename != file_shown_in_view, r[1].filename != file_shown_in_view)
+            # sort by file equality to checked files
+            res = cmp(l[1].filename not in filenames, r[1].filename not in filenames)
             if res == 0:
                 # then by file
                 res = cmp(l[1].filename, r[1].filename)
@@ -73,6 +98,48 @@ def run_ghcmods(cmds, msg, alter_messages_cb = None):
 def run_ghcmod(cmd, msg, alter_messages_cb = None):
     run_ghcmods([cmd], msg, alter_messages_cb)
 
+class SaveChecks(object):
+    """
+    Collects files saved within 'check_coalesce_delay' milliseconds (e.g. by "save all")
+    and checks them with one ghc-mod invocation per project.
+    Used only from main thread.
+    """
+    def __init__(self):
+        # Files to check (dictionary: (project dir, commands) => [view, set of files])
+        self.pending = {}
+
+    def add(self, view, cmds):
+        filename = view.file_name()
+        key = (get_cabal_project_dir_of_file(filename) or os.path.dirname(filename), tuple(cmds))
+        if key in self.pending:
+            self.pending[key][0] = view
+            self.pending[key][1].add(filename)
+            return
+        self.pending[key] = [view, set([filename])]
+        sublime.set_timeout(lambda: self.flush(key), get_setting('check_coalesce_delay', 300))
+
+    def flush(self, key):
+        view, files = self.pending.pop(key)
+        cmds = list(key[1])
+        if cmds == ['check', 'lint']:
+            run_ghcmods(cmds, 'Checking and Lintind', lint_as_hints, sorted(files), view)
+        elif cmds == ['check']:
+            run_ghcmods(cmds, 'Checking', None, sorted(files), view)
+        else:
+            run_ghcmods(cmds, 'Linting', None, sorted(files), view)
+
+save_checks = SaveChecks()
+
+def check_saved_file(view, check, lint):
+    "Check and/or lint saved file, files saved together are checked together"
+    cmds = []
+    if check:
+        cmds.append('check')
+    if lint:
+        cmds.append('lint')
+    if cmds:
+        save_checks.add(view, cmds)
+
 def run_ghcmods_thread(view, file_dir, msg, cmds_with_args, alter_messages_cb):
     sublime.status_message(msg + '...')
     thread = Thread(
@@ -81,27 +148,63 @@ def run_ghcmods_thread(view, file_dir, msg, cmds_with_args, alter_messages_cb):
     thread.start()
 
 def wait_ghcmod_and_parse(view, file_dir, msg, cmds_with_args, alter_messages_cb):
+    """
+    Run ghc-mod commands concurrently, process_executor limits number of running ghc-mod processes.
+    Messages of each command are shown as soon as it finishes,
+    output with all messages is shown when all commands are done.
+    alter_messages_cb is called for messages of each command and then for all of them,
+    so it should be idempotent.
+    """
     sublime.set_timeout(lambda: hide_output(view), 0)
 
-    exit_success = True
+    results_lock = threading.Lock()
+    results = { 'success': True, 'messages': [] }
 
-    parsed_messages = []
+    def run_command(cmd, args):
+        key = ghcmod_results.key(cmd, file_dir, args)
+        cached = ghcmod_results.get(key)
+        if cached:
+            success, parsed = cached
+        else:
+            try:
+                stdout = call_ghcmod_and_wait(args, file_dir, PRIORITY_CHECK) or ''
+            except Exception, e:
+                log('ghc-mod {0} failed: {1}'.format(cmd, e))
+                with results_lock:
+                    results['success'] = False
+                return
 
-    for (cmd, args) in cmds_with_args:
-        stdout = call_ghcmod_and_wait(args, file_dir)
+            # stdout contains NULL as line endings within one message
+            # error_output_regex using indents to determine one message scope
+            # Replace NULLs to indents
+            out = stdout.replace('\0', '\n  ').decode('utf-8')
 
-        # stdout contains NULL as line endings within one message
-        # error_output_regex using indents to determine one message scope
-        # Replace NULLs to indents
-        out = stdout.replace('\0', '\n  ').decode('utf-8')
+            success = len(out) == 0
+            parsed = parse_output_messages(file_dir, out)
+            ghcmod_results.put(key, success, parsed)
 
-        exit_success = exit_success and len(out) == 0
+        parsed = [(cmd, p) for p in parsed]
+        if alter_messages_cb:
+            alter_messages_cb(parsed)
+
+        # Show messages of this command without waiting for others
+        checked_files = [os.path.join(file_dir, name) for name in args[1:]]
+        show_diagnostics(diagnostics.update(cmd, [m for (c, m) in parsed], checked_files))
 
-        parsed = parse_output_messages(file_dir, out)
-        for p in parsed:
-            parsed_messages.append((cmd, p))
+        with results_lock:
+            results['success'] = results['success'] and success
+            results['messages'].extend(parsed)
 
-    exit_code = 0 if exit_success else 1
+    threads = []
+    for (cmd, args) in cmds_with_args:
+        thread = Thread(target=run_command, args=(cmd, args))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    parsed_messages = results['messages']
+    exit_code = 0 if results['success'] else 1
 
     if alter_messages_cb:
         alter_messages_cb(parsed_messages)
@@ -110,4 +213,182 @@ def wait_ghcmod_and_parse(view, file_dir, msg, cmds_with_args, alter_messages_cb
     output_text = format_output_messages(concated_messages)
 
     show_output_result_text(view, msg, output_text, exit_code, file_dir)
-    sublime.set_timeout(lambda: mark_messages_in_views(concated_messages), 0)
+
+# Number of ghc-mod results kept in cache
+GHCMOD_CACHE_SIZE = 256
+
+class GhcModResults(object):
+    """
+    Cache of parsed ghc-mod results keyed by hashes of inputs:
+    for lint it's contents of files, for check it's contents of files, of modules of project they import
+    and of .cabal file, and settings version (sandbox and PATH can change installed packages)
+    """
+    def __init__(self):
+        # key => (success, list of messages)
+        self.results = BoundedCache(GHCMOD_CACHE_SIZE, 'ghc-mod results')
+
+    def key(self, cmd, file_dir, args):
+        """Returns key of inputs of ghc-mod command or None if results of command are not cached
+        Must be called before running command, so that contents of files are not changed after it"""
+        if cmd not in ['check', 'lint']:
+            return None
+        filenames = [os.path.join(file_dir, name) for name in args[1:]]
+        settings_version = None
+        try:
+            sources = [(f, get_file_hash(f)) for f in filenames]
+            if cmd == 'check':
+                settings_version = get_settings_version()
+                imports = set()
+                cabal_files = set()
+                for filename in filenames:
+                    file_imports = get_project_imports(filename)
+                    # Index didn't answer, imports are unknown
+                    if file_imports is None:
+                        return None
+                    imports.update(file_imports)
+                    project_dir = get_cabal_project_dir_of_file(filename)
+                    if project_dir is not None:
+                        cabal_files.add(get_cabal_in_dir(project_dir)[1])
+                sources.extend((f, get_file_hash(f)) for f in sorted(imports) if f not in filenames)
+                sources.extend((f, get_file_hash(f)) for f in sorted(cabal_files) if f is not None)
+        except (IOError, OSError):
+            return None
+        return (tuple(try_attach_sandbox(['ghc-mod'] + args)), file_dir, tuple(sources), settings_version)
+
+    def get(self, key):
+        "Returns (success, list of messages) for key, messages are copies and can be altered"
+        if key is None:
+            return None
+        cached = self.results.get(key)
+        if cached is None:
+            return None
+        return (cached[0], [copy.copy(m) for m in cached[1]])
+
+    def put(self, key, success, messages):
+        if key is None:
+            return
+        self.results.put(key, (success, [copy.copy(m) for m in messages]))
+
+ghcmod_results = GhcModResults()
+
+def get_project_imports(filename):
+    """Returns files of same cabal project, which are imported by file directly or indirectly
+    Returns None if index didn't answer"""
+    project_dir = get_cabal_project_dir_of_file(filename)
+    if project_dir is None:
+        return []
+    return autocompletion.index.project_imports(filename, project_dir)
+
+# Mirrors of unsaved buffers are written here
+MIRROR_DIR = os.path.join(tempfile.gettempdir(), 'SublimeHaskell')
+
+def write_mirror(filename, text):
+    """Write buffer contents of file to temporary mirror file, returns path of mirror
+    Mirror has same name as file, so that module name and extension stay valid"""
+    mirror_dir = os.path.join(MIRROR_DIR, hashlib.md5(filename.encode('utf-8')).hexdigest())
+    if not os.path.exists(mirror_dir):
+        os.makedirs(mirror_dir)
+    mirror = os.path.join(mirror_dir, os.path.basename(filename))
+    with codecs.open(mirror, 'w', 'utf-8') as f:
+        f.write(text)
+    return mirror
+
+class SublimeHaskellCheckAsYouType(sublime_plugin.EventListener):
+    """
+    Checks and lints buffer contents when user stops typing for 'check_as_you_type_delay' milliseconds.
+    Buffer is saved to mirror file, so ghc-mod sees unsaved changes.
+    Typing again cancels running check.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Generation of buffer contents (dictionary: view id => generation)
+        self.generations = {}
+        # Handles of running ghc-mod processes (dictionary: view id => list of handles)
+        self.handles = {}
+
+    def on_modified(self, view):
+        if not get_setting('enable_check_as_you_type'):
+            return
+        if not view.file_name() or 'haskell' not in view.settings().get('syntax').lower():
+            return
+        view_id = view.id()
+        with self.lock:
+            generation = self.generations.get(view_id, 0) + 1
+            self.generations[view_id] = generation
+            self._cancel_processes(view_id)
+        sublime.set_timeout(lambda: self.on_idle(view, generation), get_setting('check_as_you_type_delay', 500))
+
+    def on_close(self, view):
+        with self.lock:
+            self.generations.pop(view.id(), None)
+            self._cancel_processes(view.id())
+
+    def _cancel_processes(self, view_id):
+        "Kill running checks of view, must be called with lock held"
+        for handle in self.handles.pop(view_id, []):
+            handle.cancel()
+
+    def on_idle(self, view, generation):
+        with self.lock:
+            if self.generations.get(view.id()) != generation:
+                # User typed again
+                return
+        cmds = []
+        if get_setting('enable_auto_check'):
+            cmds.append('check')
+        if get_setting('enable_auto_lint'):
+            cmds.append('lint')
+        if not cmds:
+            return
+        text = view.substr(sublime.Region(0, view.size()))
+        thread = Thread(
+            target=self.check,
+            args=(view.id(), generation, view.file_name(), text, cmds))
+        thread.start()
+
+    def check(self, view_id, generation, filename, text, cmds):
+        file_dir = os.path.dirname(filename)
+        mirror = write_mirror(filename, text)
+
+        handles = [ProcessHandle() for cmd in cmds]
+        with self.lock:
+            if self.generations.get(view_id) != generation:
+                return
+            self.handles[view_id] = handles
+
+        # Output of each command (dictionary: cmd => stdout)
+        results = {}
+
+        def run_command(cmd, handle):
+            try:
+                results[cmd] = process_executor.run(try_attach_sandbox(['ghc-mod', cmd, mirror]), PRIORITY_CHECK, handle = handle, cwd = file_dir)[1]
+            except OSError, e:
+                log('ghc-mod failed: {0}'.format(e))
+
+        threads = [Thread(target=run_command, args=(cmd, handle)) for (cmd, handle) in zip(cmds, handles)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with self.lock:
+            if self.generations.get(view_id) != generation:
+                # Cancelled, buffer changed
+                return
+            self.handles.pop(view_id, None)
+
+        outputs = [(cmd, results[cmd]) for cmd in cmds if cmd in results]
+
+        changed = {}
+        for cmd, stdout in outputs:
+            out = stdout.replace('\0', '\n  ').decode('utf-8')
+            messages = parse_output_messages(file_dir, out)
+            for m in messages:
+                # Map messages back to real file
+                if m.filename == os.path.normpath(mirror):
+                    m.filename = filename
+                # Lint as hints when checking too
+                if cmd == 'lint' and len(cmds) > 1:
+                    m.level = 'hint'
+            changed.update(diagnostics.update(cmd, messages, [filename]))
+        show_diagnostics(changed)
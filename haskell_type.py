@@ -1,9 +1,13 @@
+import os
 import sublime
 import sublime_plugin
 import re
+import threading
+from threading import Thread
 
-from sublime_haskell_common import call_ghcmod_and_wait
+from sublime_haskell_common import call_and_wait, process_executor, ProcessHandle, PRIORITY_INTERACTIVE, try_attach_sandbox, get_cabal_project_dir_of_file, get_file_hash, get_setting, log, BoundedCache
 from cabalbuild import is_enabled_haskell_command
+from autocomplete import autocompletion
 
 # Used to find out the module name.
 MODULE_RE_STR = r'module\s+([^\s\(]*)' # "module" followed by everything that is neither " " nor "("
@@ -25,47 +29,235 @@ def parse_ghc_mod_type_line(l):
     match = GHCMOD_TYPE_LINE_RE.match(l)
     return match and match.groupdict()
 
-# TODO rename to SublimeHaskellShowTypeCommand
-class HaskellShowTypeCommand(sublime_plugin.TextCommand):
-    def ghcmod_get_type_of_cursor(self):
-        view = self.view
+# Number of cached types
+TYPE_CACHE_SIZE = 1024
 
-        filename = str(view.file_name())
-        row, col = view.rowcol(view.sel()[0].a)
-        row1, col1 = row + 1, col + 1  # ghc-mod uses rows/cols starting with 1
-        module_region = view.find(MODULE_RE_STR, 0)
+# Max number of positions, for which ghc-mod is run one by one, when ghc-modi fails
+GHCMOD_TYPE_FALLBACK_LIMIT = 10
 
-        if module_region is None:
-            sublime.status_message("SublimeHaskell: Could not determine module name!")
-            return None
+# Types of expressions by (file hash, row, col), where row and col are 1-based
+type_cache = BoundedCache(TYPE_CACHE_SIZE, 'types')
 
-        # RE must match; there is only one group in the RE.
-        module = MODULE_RE.match(view.substr(module_region)).group(1)
+def parse_ghc_mod_type_spans(out):
+    "Returns list of (startrow, startcol, endrow, endcol, type) parsed from `ghc-mod type` output, innermost first"
+    spans = []
+    for t in filter(None, map(parse_ghc_mod_type_line, out.strip().splitlines())):
+        spans.append((int(t['startrow']), int(t['startcol']), int(t['endrow']), int(t['endcol']), t['type']))
+    return spans
 
-        ghcmod_args = ['type', filename, module, str(row1), str(col1)]
-        out = call_ghcmod_and_wait(ghcmod_args)
+class GhcModiError(Exception):
+    "ghc-modi session failed"
+    pass
 
-        if not out:
-            sublime.status_message("ghc-mod %s returned nothing" % ' '.join(ghcmod_args))
-            return None
+class GhcModiCommandError(Exception):
+    "ghc-modi answered NG to command, session can still be used"
+    pass
 
-        # ghc-mod type returns the type of the expression at at the given row/col.
-        # It can return multiple lines, extending the expression scope by one level each.
-        # The last line belongs to the toplevel expression.
-        types = map(parse_ghc_mod_type_line, out.strip().splitlines())
-        result_type = types[0]['type']  # innermost expression's type
+class GhcModiSession(object):
+    """
+    ghc-modi process to query many types with one typecheck.
+    ghc-modi reads commands line by line, output of each command ends with line 'OK' or 'NG ...'.
+    """
+    def __init__(self, cwd, priority):
+        self.process = process_executor.start(try_attach_sandbox(['ghc-modi']), priority, cwd=cwd)
+        # Read stderr, otherwise ghc-modi blocks when pipe is full
+        drain = Thread(target=self.drain_stderr)
+        drain.daemon = True
+        drain.start()
 
-        if not result_type:
-            sublime.error_message("ghc-mod type returned unexpected output")
-            return None
+    def drain_stderr(self):
+        try:
+            for line in iter(self.process.stderr.readline, ''):
+                log('ghc-modi: {0}'.format(line.rstrip('\r\n')))
+        except (IOError, ValueError):
+            pass
 
-        return result_type
+    def command(self, cmd):
+        "Run command and return its output lines, raises GhcModiCommandError on NG and GhcModiError on failure"
+        try:
+            self.process.stdin.write(cmd + '\n')
+            self.process.stdin.flush()
+        except IOError, e:
+            raise GhcModiError(str(e))
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise GhcModiError('ghc-modi terminated')
+            line = line.rstrip('\r\n')
+            if line == 'OK':
+                return lines
+            if line.startswith('NG'):
+                raise GhcModiCommandError(line)
+            lines.append(line)
 
-    def run(self, edit):
-        result_type = self.ghcmod_get_type_of_cursor()
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+        process_executor.release(self.process)
+
+def query_types(filename, module, positions, priority):
+    """
+    Returns spans (see parse_ghc_mod_type_spans) of `ghc-mod type` for each (row, col) of positions (starting with 1).
+    All positions are queried in one ghc-modi session. If ghc-modi is not available or fails,
+    ghc-mod is run for each of remaining positions, but no more than GHCMOD_TYPE_FALLBACK_LIMIT times,
+    other positions get no spans.
+    Must be called from worker thread.
+    """
+    results = []
+    if not positions:
+        return results
+    cwd = get_cabal_project_dir_of_file(filename) or os.path.dirname(filename)
+    try:
+        session = GhcModiSession(cwd, priority)
+        try:
+            for (row, col) in positions:
+                try:
+                    results.append(parse_ghc_mod_type_spans('\n'.join(session.command('type {0} {1} {2}'.format(filename, row, col)))))
+                except GhcModiCommandError, e:
+                    log('ghc-modi type {0} {1} {2} failed: {3}'.format(filename, row, col, e))
+                    results.append([])
+            return results
+        finally:
+            session.close()
+    except (OSError, GhcModiError), e:
+        log('ghc-modi failed, running ghc-mod for each type: {0}'.format(e))
+
+    remaining = positions[len(results):]
+    if len(remaining) > GHCMOD_TYPE_FALLBACK_LIMIT:
+        log('too many types to query with ghc-mod, {0} of {1} are skipped'.format(len(remaining) - GHCMOD_TYPE_FALLBACK_LIMIT, len(remaining)))
+    for (row, col) in remaining[:GHCMOD_TYPE_FALLBACK_LIMIT]:
+        exit_code, out, err = call_and_wait(try_attach_sandbox(['ghc-mod', 'type', filename, module, str(row), str(col)]), priority)
+        results.append(parse_ghc_mod_type_spans(out) if exit_code == 0 else [])
+    results.extend([] for p in remaining[GHCMOD_TYPE_FALLBACK_LIMIT:])
+    return results
+
+class TypeQuery(object):
+    """
+    Runs `ghc-mod type` in background.
+    New query cancels running one, so only the result of the latest query is reported.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0
+        # Handle of running ghc-mod
+        self.handle = None
+
+    def query(self, filename, module, row1, col1, on_result):
+        """
+        Get type of expression at row1, col1 (starting with 1) of file.
+        on_result(type) is called in main thread, type is None if there is no result.
+        """
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            self.cancel_process()
+        thread = Thread(
+            target=self.run_query,
+            args=(generation, filename, module, row1, col1, on_result))
+        thread.start()
+
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+            self.cancel_process()
+
+    def cancel_process(self):
+        "Kill running ghc-mod, must be called with lock held"
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def run_query(self, generation, filename, module, row1, col1, on_result):
+        try:
+            file_hash = get_file_hash(filename)
+        except (IOError, OSError):
+            file_hash = None
+        key = (file_hash, row1, col1)
+        result_type = None
+        if file_hash:
+            result_type = type_cache.get(key)
+
+        if result_type is None:
+            ghcmod_args = ['type', filename, module, str(row1), str(col1)]
+            handle = ProcessHandle()
+            with self.lock:
+                if generation != self.generation:
+                    return
+                self.handle = handle
+            try:
+                exit_code, out, err = call_and_wait(try_attach_sandbox(['ghc-mod'] + ghcmod_args), PRIORITY_INTERACTIVE, handle)
+            except OSError, e:
+                log('ghc-mod failed: {0}'.format(e))
+                return
+            with self.lock:
+                if generation != self.generation:
+                    # Superseded by newer query
+                    return
+                self.handle = None
+
+            # ghc-mod type returns the type of the expression at at the given row/col.
+            # It can return multiple lines, extending the expression scope by one level each.
+            # The last line belongs to the toplevel expression.
+            spans = parse_ghc_mod_type_spans(out)
+            if spans:
+                result_type = spans[0][4]  # innermost expression's type
+                if file_hash:
+                    type_cache.put(key, result_type)
+            else:
+                log("ghc-mod %s returned nothing" % ' '.join(ghcmod_args))
+
+        def report():
+            with self.lock:
+                if generation != self.generation:
+                    return
+            on_result(result_type)
+        sublime.set_timeout(report, 0)
+
+def get_type_query_args(view):
+    """
+    Returns (filename, module, row, col) of cursor in view for ghc-mod type, row and col start with 1
+    Returns None if module name can't be determined.
+    Must be called from main thread.
+    """
+    filename = str(view.file_name())
+    row, col = view.rowcol(view.sel()[0].a)
+    row1, col1 = row + 1, col + 1  # ghc-mod uses rows/cols starting with 1
+    module_region = view.find(MODULE_RE_STR, 0)
+
+    if module_region is None:
+        return None
+
+    # RE must match; there is only one group in the RE.
+    module = MODULE_RE.match(view.substr(module_region)).group(1)
+    return (filename, module, row1, col1)
+
+# Queries of commands, cursor type queries are separate, so that they don't cancel each other
+command_type_query = TypeQuery()
+
+# TODO rename to SublimeHaskellShowTypeCommand
+class HaskellShowTypeCommand(sublime_plugin.TextCommand):
+    def query_type_of_cursor(self, on_result):
+        "Asynchronously get type of expression under cursor, on_result(type) is called with non-empty type"
+        args = get_type_query_args(self.view)
+        if args is None:
+            sublime.status_message("SublimeHaskell: Could not determine module name!")
+            return
+
+        def on_type(result_type):
+            if not result_type:
+                sublime.status_message("SublimeHaskell: ghc-mod type returned nothing")
+                return
+            on_result(result_type)
 
-        if result_type:
-            self.write_output(self.view, result_type)
+        sublime.status_message("SublimeHaskell: Getting type...")
+        command_type_query.query(*(args + (on_type,)))
+
+    def run(self, edit):
+        self.query_type_of_cursor(lambda result_type: self.write_output(self.view, result_type))
 
     def write_output(self, view, text):
         "Write text to Sublime's output panel."
@@ -84,21 +276,145 @@ class HaskellShowTypeCommand(sublime_plugin.TextCommand):
         return is_enabled_haskell_command()
 
 
+class SublimeHaskellInsertMissingTypes(sublime_plugin.TextCommand):
+    """
+    Inserts type signatures for all top-level bindings of module, which have no signature.
+    Bindings are known from ModuleInspector, their types are queried in one batch.
+    """
+    def run(self, edit):
+        view = self.view
+        filename = view.file_name()
+        # ghc-mod and ModuleInspector see file on disk only
+        if view.is_dirty():
+            sublime.status_message("SublimeHaskell: Save file to insert type signatures")
+            return
+        info = autocompletion.index.file_info(filename)
+        if not info:
+            sublime.status_message("SublimeHaskell: File is not inspected yet")
+            return
+        module = info['moduleName']
+        declarations = info['declarations']
+        bindings = info.get('bindings', [])
+
+        signed = set([d['identifier'] for d in declarations if d['info'].startswith('::')])
+        # (line, column of binding, column to query, name, indent) for bindings without signature
+        missing = []
+        for b in bindings:
+            name = b['identifier']
+            if name in signed:
+                continue
+            signed.add(name)
+            line_text = view.substr(view.line(view.text_point(b['line'] - 1, 0)))
+            column = b['column'] - 1
+            rest = line_text[column:]
+            if rest.startswith(name):
+                missing.append((b['line'], b['column'], b['column'], name, line_text[:column]))
+            elif rest.startswith('(' + name + ')'):
+                # Operator defined in prefix form
+                missing.append((b['line'], b['column'], b['column'] + 1, '(' + name + ')', line_text[:column]))
+            # Infix definitions are skipped, there is no name at binding location
+
+        if not missing:
+            sublime.status_message("SublimeHaskell: No missing type signatures")
+            return
+
+        change_count = view.change_count()
+        sublime.status_message("SublimeHaskell: Getting types...")
+
+        def get_types():
+            spans_list = query_types(filename, module, [(m[0], m[2]) for m in missing], PRIORITY_INTERACTIVE)
+            signatures = []
+            for (m, spans) in zip(missing, spans_list):
+                # Innermost span must start at binding
+                if spans and spans[0][:2] == (m[0], m[1]):
+                    signatures.append((m[0], "{0}{1} :: {2}\n".format(m[4], m[3], spans[0][4])))
+            sublime.set_timeout(lambda: self.insert_signatures(change_count, signatures), 0)
+
+        Thread(target=get_types).start()
+
+    def insert_signatures(self, change_count, signatures):
+        view = self.view
+        # Buffer could be changed while types were queried
+        if view.change_count() != change_count:
+            sublime.status_message("SublimeHaskell: File changed, type signatures are not inserted")
+            return
+        insert_edit = view.begin_edit()
+        # Insert from the end, so that line numbers of remaining bindings are valid
+        for (line, signature) in sorted(signatures, reverse=True):
+            view.insert(insert_edit, view.text_point(line - 1, 0), signature)
+        view.end_edit(insert_edit)
+        sublime.status_message("SublimeHaskell: Inserted {0} type signatures".format(len(signatures)))
+
+    def is_enabled(self):
+        return is_enabled_haskell_command()
+
 # Works only with the cursor being in the name of a toplevel function so far.
 class HaskellInsertTypeCommand(HaskellShowTypeCommand):
     def run(self, edit):
         view = self.view
-        result_type = self.ghcmod_get_type_of_cursor()
 
-        if result_type:
-            # TODO get this from ghc-mod as well, e.g. from the range of the type
-            word_region = view.word(view.sel()[0])
-            line_region = view.line(view.sel()[0])
-            indent_region = sublime.Region(line_region.begin(), word_region.begin())
+        # TODO get this from ghc-mod as well, e.g. from the range of the type
+        word_region = view.word(view.sel()[0])
+        line_region = view.line(view.sel()[0])
+        indent_region = sublime.Region(line_region.begin(), word_region.begin())
 
-            indent = view.substr(indent_region)
-            fn_name = view.substr(word_region)
+        indent = view.substr(indent_region)
+        fn_name = view.substr(word_region)
+        line_text = view.substr(line_region)
+
+        def insert_type(result_type):
+            # Buffer could be changed while ghc-mod was running
+            if view.substr(view.line(line_region.begin())) != line_text:
+                sublime.status_message("SublimeHaskell: File changed, type is not inserted")
+                return
 
             signature = "{0}{1} :: {2}\n".format(indent, fn_name, result_type)
 
-            view.insert(edit, line_region.begin(), signature)
+            insert_edit = view.begin_edit()
+            view.insert(insert_edit, line_region.begin(), signature)
+            view.end_edit(insert_edit)
+
+        self.query_type_of_cursor(insert_type)
+
+# Name of status bar entry with type of expression under cursor
+TYPE_STATUS_KEY = 'sublime_haskell_type'
+
+class SublimeHaskellTypeInStatusBar(sublime_plugin.EventListener):
+    """
+    Shows type of expression under cursor in status bar,
+    when cursor stays still for 'type_in_status_bar_delay' milliseconds.
+    """
+    def __init__(self):
+        self.type_query = TypeQuery()
+        # Incremented when cursor moves
+        self.generation = 0
+
+    def on_selection_modified(self, view):
+        if not get_setting('show_type_in_status_bar'):
+            return
+        if not is_haskell_view(view):
+            return
+        self.generation += 1
+        generation = self.generation
+        self.type_query.cancel()
+        view.erase_status(TYPE_STATUS_KEY)
+        sublime.set_timeout(lambda: self.on_idle(view, generation), get_setting('type_in_status_bar_delay', 500))
+
+    def on_idle(self, view, generation):
+        if generation != self.generation:
+            return
+        # ghc-mod sees file on disk only
+        if view.is_dirty() or len(view.sel()) == 0:
+            return
+        args = get_type_query_args(view)
+        if args is None:
+            return
+
+        def on_type(result_type):
+            if generation == self.generation and result_type:
+                view.set_status(TYPE_STATUS_KEY, u':: {0}'.format(result_type))
+
+        self.type_query.query(*(args + (on_type,)))
+
+def is_haskell_view(view):
+    return view.file_name() is not None and 'haskell' in view.settings().get('syntax').lower()
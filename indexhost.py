@@ -0,0 +1,316 @@
+"""
+Index of inspected modules: declarations of project modules (by ModuleInspector)
+and of standard modules (by ghc-mod browse).
+
+Index can be used in plugin process or run in separate process as script (python indexhost.py),
+so that inspection and JSON decoding don't block the plugin host.
+Separate process is controlled with JSON messages over stdin and stdout, one message per line:
+    request: {"id": 1, "method": "completions", "params": ["/path/Main.hs", ""]}
+    response: {"id": 1, "result": [...]} or {"id": 1, "error": "message"}
+    log message: {"log": "message"}
+Any method of ModuleIndex can be called, and 'configure_runner' sets environment and timeouts of processes.
+
+This module must not depend on sublime modules, it runs with both Python 2 and 3.
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+
+# Module info is written to cache file once in this time (seconds) after change
+CACHE_WRITE_DELAY = 2.0
+
+class ModuleIndex(object):
+    """
+    Information of modules.
+    run(command) runs command and returns (exit_code, stdout, stderr).
+    """
+    def __init__(self, run, log):
+        self.run = run
+        self.log = log
+        self.inspector_path = None
+        self.cache_path = None
+        # Arguments appended to ghc-mod commands, e.g. sandbox
+        self.ghcmod_args = []
+        self.lock = threading.Lock()
+        # Module info (dictionary: filename => info)
+        # info is:
+        #   moduleName - name of module
+        #   exportList - list of export (strings)
+        #   imports - list of import (strings), where import is:
+        #     importName - name of imported module
+        #     qualified - is import qualified?
+        #     as - alias of module (string or null)
+        #   declarations - list of declarations, where declaration is:
+        #     info - type info (string "(data)", "(type)" or "(class)")
+        #     identifier - declaration identifier
+        #   bindings - list of top-level bindings, where binding is:
+        #     identifier - bound name
+        #     line, column - location of binding
+        #   inspectedAt - modification time of inspected file
+        self.info = {}
+        # Standard module completions (dictionary: module name => completions):
+        self.std_info = {}
+        # Is write of module info to cache file scheduled?
+        self.cache_write_pending = False
+
+    def configure(self, inspector_path, cache_path, ghcmod_args):
+        self.inspector_path = inspector_path
+        self.cache_path = cache_path
+        self.ghcmod_args = ghcmod_args
+
+    def inspect(self, filename):
+        """
+        Rebuild module information for the specified file, if it has changed since it was last inspected.
+        Returns True if information was updated.
+        """
+        modification_time = os.stat(filename).st_mtime
+        with self.lock:
+            inspection_time = self.info.get(filename, {}).get('inspectedAt', 0.0)
+        if modification_time <= inspection_time:
+            return False
+
+        exit_code, stdout, stderr = self.run([self.inspector_path, filename])
+        # Update only when module is ok
+        if exit_code != 0:
+            return False
+        new_info = json.loads(decode(stdout))
+        if 'error' in new_info:
+            return False
+
+        # Load standard modules
+        for mi in new_info.get('imports', []):
+            if 'importName' in mi:
+                self.load_standard_module(mi['importName'])
+
+        # Remember when this info was collected.
+        new_info['inspectedAt'] = modification_time
+        with self.lock:
+            self.info[filename] = new_info
+        self._schedule_cache_write()
+        return True
+
+    def _schedule_cache_write(self):
+        "Dump the currently-known module info to disk soon, so that many inspections in a row are written once"
+        if not self.cache_path:
+            return
+        with self.lock:
+            if self.cache_write_pending:
+                return
+            self.cache_write_pending = True
+        timer = threading.Timer(CACHE_WRITE_DELAY, self._write_cache)
+        timer.daemon = True
+        timer.start()
+
+    def _write_cache(self):
+        # Info of file is replaced, not changed, so copy of dictionary can be serialized without lock
+        with self.lock:
+            self.cache_write_pending = False
+            info = dict(self.info)
+        try:
+            with open(self.cache_path, 'w') as f:
+                f.write(json.dumps(info))
+        except IOError as e:
+            self.log('can\'t write module info cache: {0}'.format(e))
+
+    def load_standard_module(self, module_name):
+        with self.lock:
+            if module_name in self.std_info:
+                return
+        exit_code, stdout, stderr = self.run(['ghc-mod', 'browse', module_name] + self.ghcmod_args)
+        if exit_code != 0:
+            self.log('ghc-mod browse {0} failed: {1}'.format(module_name, decode(stderr)))
+            return
+        with self.lock:
+            self.std_info[module_name] = decode(stdout).splitlines()
+
+    def forget(self, filename):
+        "Remove info of deleted file"
+        with self.lock:
+            self.info.pop(filename, None)
+        self._schedule_cache_write()
+
+    def file_info(self, filename):
+        "Returns info of file or None if it is not inspected"
+        with self.lock:
+            return self.info.get(filename)
+
+    def completions(self, filename, qualified_module):
+        """
+        Returns identifiers of modules imported by file.
+        If qualified_module is not empty, only identifiers of this module (or alias) are returned.
+        """
+        with self.lock:
+            imports = self.info.get(filename, {}).get('imports', [])
+            if qualified_module:
+                # if qualified_module is alias, find its original name
+                # e.g. for 'import Data.Text as T' return 'Data.Text' for 'T'
+                module_imports = [m['importName'] for m in imports if m['as'] == qualified_module]
+                module_imports.append(qualified_module)
+            else:
+                # list of imports, imported unqualified
+                module_imports = [m['importName'] for m in imports if not m['qualified']]
+
+            identifiers = set()
+            for file_info in self.info.values():
+                # File is imported, add to completion list
+                if file_info.get('moduleName') in module_imports:
+                    identifiers.update([d['identifier'] for d in file_info['declarations']])
+            # Completion for modules by ghc-mod browse
+            for mi in module_imports:
+                identifiers.update(self.std_info.get(mi, []))
+        return sorted(identifiers)
+
+    def declarations(self):
+        "Returns list of (filename, module name, declaration) of all inspected modules"
+        with self.lock:
+            return [(f, v['moduleName'], d) for (f, v) in self.info.items() for d in v.get('declarations', [])]
+
+    def std_declarations(self):
+        "Returns list of (module name, declaration) of standard modules"
+        with self.lock:
+            return [(m, d) for (m, decls) in self.std_info.items() for d in decls]
+
+    def find_declaration(self, identifier):
+        "Returns list of (filename, line, column) of declarations of identifier"
+        with self.lock:
+            return [(f, d['line'], d['column']) for (f, v) in self.info.items() for d in v.get('declarations', []) if d['identifier'] == identifier]
+
+    def project_imports(self, filename, project_dir):
+        "Returns files of project, which are imported by file directly or indirectly"
+        with self.lock:
+            project_modules = {}
+            imports = {}
+            for f, info in self.info.items():
+                if 'moduleName' in info and f.startswith(project_dir + os.sep):
+                    project_modules[info['moduleName']] = f
+                    imports[f] = [i['importName'] for i in info.get('imports', [])]
+        result = set()
+        to_visit = [filename]
+        while to_visit:
+            f = to_visit.pop()
+            for module_name in imports.get(f, []):
+                imported = project_modules.get(module_name)
+                if imported and imported not in result and imported != filename:
+                    result.add(imported)
+                    to_visit.append(imported)
+        return sorted(result)
+
+def decode(output):
+    "Decode process output to unicode"
+    if isinstance(output, bytes):
+        return output.decode('utf-8', 'replace')
+    return output
+
+def native(s):
+    "Python 2 subprocess needs byte strings"
+    if sys.version_info[0] < 3 and not isinstance(s, str):
+        return s.encode('utf-8')
+    return s
+
+class ProcessRunner(object):
+    "Runs processes of index host with environment and timeouts set by plugin"
+    def __init__(self, log):
+        self.log = log
+        self.env = None
+        # Timeouts in seconds (dictionary: tool name => timeout)
+        self.timeouts = {}
+
+    def configure(self, env, timeouts):
+        self.env = dict((native(k), native(v)) for (k, v) in env.items())
+        self.timeouts = timeouts
+
+    def run(self, command):
+        startupinfo = None
+        if os.name == 'nt':
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        process = subprocess.Popen(
+            [native(c) for c in command],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            env=self.env,
+            startupinfo=startupinfo)
+        tool = os.path.splitext(os.path.basename(command[0]))[0]
+        timer = None
+        if self.timeouts.get(tool):
+            timer = threading.Timer(self.timeouts[tool], lambda: kill(process))
+            timer.daemon = True
+            timer.start()
+        stdout, stderr = process.communicate()
+        if timer:
+            timer.cancel()
+        return (process.wait(), stdout, stderr)
+
+def kill(process):
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+class IndexHost(object):
+    """
+    Serves requests to index from stdin.
+    Long requests (inspect) are run one by one in worker thread, others are answered at once.
+    """
+    LONG_METHODS = ['inspect', 'load_standard_module']
+
+    def __init__(self, input, output):
+        self.input = input
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.runner = ProcessRunner(self.log)
+        self.index = ModuleIndex(self.runner.run, self.log)
+        self.long_requests = []
+        self.long_requests_condition = threading.Condition()
+
+    def send(self, message):
+        line = json.dumps(message) + '\n'
+        with self.output_lock:
+            self.output.write(line)
+            self.output.flush()
+
+    def log(self, message):
+        self.send({ 'log': message })
+
+    def handle(self, request):
+        try:
+            if request['method'] == 'configure_runner':
+                result = self.runner.configure(*request['params'])
+            elif request['method'].startswith('_') or not hasattr(self.index, request['method']):
+                raise ValueError('unknown method {0}'.format(request['method']))
+            else:
+                result = getattr(self.index, request['method'])(*request['params'])
+            self.send({ 'id': request['id'], 'result': result })
+        except Exception as e:
+            self.send({ 'id': request['id'], 'error': '{0}: {1}'.format(type(e).__name__, e) })
+
+    def run_long_requests(self):
+        while True:
+            with self.long_requests_condition:
+                while not self.long_requests:
+                    self.long_requests_condition.wait()
+                request = self.long_requests.pop(0)
+            self.handle(request)
+
+    def serve(self):
+        worker = threading.Thread(target=self.run_long_requests)
+        worker.daemon = True
+        worker.start()
+        while True:
+            line = self.input.readline()
+            if not line:
+                # Plugin host exited
+                return
+            request = json.loads(line)
+            if request['method'] in self.LONG_METHODS:
+                with self.long_requests_condition:
+                    self.long_requests.append(request)
+                    self.long_requests_condition.notify()
+            else:
+                self.handle(request)
+
+if __name__ == '__main__':
+    IndexHost(sys.stdin, sys.stdout).serve()
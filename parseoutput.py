@@ -1,10 +1,14 @@
+import bisect
 import os
 import re
 import sublime
+import sublime_plugin
+import threading
 import time
 from threading import Thread
 
-from sublime_haskell_common import log, are_paths_equal, call_and_wait, get_setting_async
+from sublime_haskell_common import log, get_setting_async, process_executor, ProcessHandle, PRIORITY_BUILD, save_output_log, write_panel, metrics
+from buildmanifest import BuildPlan
 
 ERROR_PANEL_NAME = 'haskell_error_checker'
 
@@ -47,35 +51,170 @@ class OutputMessage(object):
 def run_build_thread(view, cabal_project_dir, msg, cmd):
     run_chain_build_thread(view, cabal_project_dir, msg, [cmd])
 
-def run_chain_build_thread(view, cabal_project_dir, msg, cmds):
+def run_chain_build_thread(view, cabal_project_dir, msg, cmds, typecheck_only = False):
     sublime.status_message(msg + '...')
-    thread = Thread(
-        target=wait_for_chain_to_complete,
-        args=(view, cabal_project_dir, msg, cmds))
-    thread.start()
-
-def wait_for_build_to_complete(view, cabal_project_dir, msg, cmd):
-    """Start 'cabal build', wait for it to complete, then parse and diplay
-    the resulting errors."""
-
-    wait_for_chain_to_complete(view, cabal_project_dir, msg, [cmd])
-
-def wait_for_chain_to_complete(view, cabal_project_dir, msg, cmds):
-    """Chains several commands, wait for them to complete, then parse and display
-    the resulting errors."""
-
     # First hide error panel to show that something is going on
-    sublime.set_timeout(lambda: hide_output(view), 0)
-
-    # run and wait commands, fail on first fail
-    for cmd in cmds:
-        exit_code, stdout, stderr = call_and_wait(
-            cmd,
-            cwd=cabal_project_dir)
-        if exit_code != 0:
-            break
-
-    parse_output_messages_and_show(view, msg, cabal_project_dir, exit_code, stderr)
+    hide_output(view)
+
+    def on_done(exit_code, stderr):
+        result_msg = msg
+        if typecheck_only:
+            exit_code, stderr, complete = get_typecheck_result(cabal_project_dir, exit_code, stderr)
+            if not complete:
+                result_msg = msg + ' (only first component typechecked)'
+        parse_output_messages_and_show(view, result_msg, cabal_project_dir, exit_code, stderr)
+
+    get_project_build(cabal_project_dir).schedule(cmds, on_done)
+
+# Errors of archive and link steps about missing object files, e.g.
+# '/usr/bin/ld: cannot find dist/build/foo/foo-tmp/Main.o', 'collect2: ld returned 1 exit status'
+LINK_FAILURE_RE = re.compile(r'(^|[\s/])(ld|ar|collect2|libtool)(\.exe)?: |\.(o|a)\b.*(No such file|does not exist)', re.MULTILINE)
+
+def get_typecheck_result(base_dir, exit_code, stderr):
+    """
+    Returns (exit_code, stderr, complete) of typecheck only build.
+    With -fno-code cabal still runs archive and link steps, which fail as there are no object files,
+    so build is successful if only these steps failed and GHC reported no errors.
+    But cabal stops on first failed step, so components after it (usually executables and tests
+    after library) are not typechecked, and complete is False then.
+    """
+    if exit_code == 0:
+        return (exit_code, stderr, True)
+    text = stderr.decode('utf-8', 'replace')
+    if not LINK_FAILURE_RE.search(text):
+        return (exit_code, stderr, True)
+    messages = parse_output_messages(base_dir, text)
+    if any(m.level == 'error' for m in messages):
+        return (exit_code, stderr, True)
+    # Warnings are still shown, link errors are not
+    return (0, stderr if messages else '', False)
+
+# Build schedulers by cabal project directory
+project_builds_lock = threading.Lock()
+project_builds = {}
+
+def get_project_build(cabal_project_dir):
+    "Returns build scheduler of cabal project, creating it on first use"
+    key = os.path.abspath(cabal_project_dir)
+    with project_builds_lock:
+        if key not in project_builds:
+            project_builds[key] = ProjectBuild(key)
+        return project_builds[key]
+
+class ProjectBuild(object):
+    """
+    Runs build commands of one cabal project, at most one build at a time.
+    A new request kills the running build and replaces the queued one,
+    so quick successive saves collapse into one build of the latest state.
+    """
+    def __init__(self, cabal_project_dir):
+        self.cabal_project_dir = cabal_project_dir
+        self.lock = threading.Lock()
+        # Incremented on every request, builds of older generations are superseded
+        self.generation = 0
+        # Queued request: (generation, cmds, on_done, on_superseded)
+        self.pending = None
+        # Handle of running build command
+        self.handle = None
+        # Is worker thread running
+        self.running = False
+
+    def schedule(self, cmds, on_done, on_superseded = None):
+        """
+        Queue chain of build commands, superseding queued and running ones.
+        on_done(exit_code, stderr) is called from worker thread unless the build
+        was superseded by a newer one, on_superseded() is called otherwise.
+        """
+        with self.lock:
+            self.generation += 1
+            dropped = self.pending
+            self.pending = (self.generation, cmds, on_done, on_superseded)
+            self._cancel_process()
+            start_thread = not self.running
+            self.running = True
+        # Queued build never started
+        if dropped and dropped[3]:
+            dropped[3]()
+        if start_thread:
+            thread = Thread(target=self._run_pending)
+            thread.start()
+
+    def _cancel_process(self):
+        "Kill running build process, must be called with lock held"
+        if self.handle is not None:
+            self.handle.cancel()
+
+    def _run_pending(self):
+        finished = False
+        try:
+            while True:
+                with self.lock:
+                    if self.pending is None:
+                        self.running = False
+                        finished = True
+                        return
+                    generation, cmds, on_done, on_superseded = self.pending
+                    self.pending = None
+                # Failed build must not stop next ones
+                try:
+                    self._run_build(generation, cmds, on_done, on_superseded)
+                except Exception, e:
+                    log('build of {0} failed: {1}'.format(self.cabal_project_dir, e))
+        finally:
+            # Let next request start new worker thread
+            if not finished:
+                with self.lock:
+                    self.running = False
+
+    def _run_build(self, generation, cmds, on_done, on_superseded):
+        begin_time = time.time()
+        try:
+            exit_code, stderr = self._run_chain(generation, cmds)
+        except Exception, e:
+            log('build of {0} failed: {1}'.format(self.cabal_project_dir, e))
+            exit_code, stderr = 1, u'Build failed: {0}'.format(e).encode('utf-8')
+        if exit_code is None:
+            metrics.count('builds superseded')
+        else:
+            metrics.record('build', time.time() - begin_time)
+            if exit_code != 0:
+                metrics.count('builds failed')
+
+        # Results of superseded builds must not overwrite newer ones
+        # Callback is called in this thread, so results of next build can't come earlier
+        if exit_code is not None:
+            on_done(exit_code, stderr)
+        elif on_superseded:
+            on_superseded()
+
+    def _run_chain(self, generation, cmds):
+        """Run commands, which are not up to date, fail on first fail
+        Returns (None, None) if build was superseded"""
+        plan = BuildPlan(self.cabal_project_dir, cmds)
+        if plan.replay is not None:
+            metrics.count('builds replayed')
+            return plan.replay
+
+        exit_code, stderr = 0, ''
+        for cmd in plan.cmds:
+            handle = ProcessHandle()
+            with self.lock:
+                if generation != self.generation:
+                    return (None, None)
+                self.handle = handle
+            try:
+                exit_code, stdout, stderr = process_executor.run(cmd, PRIORITY_BUILD, handle = handle, cwd = self.cabal_project_dir)
+            except OSError, e:
+                return (1, u'Failed to run {0}: {1}'.format(' '.join(cmd), e).encode('utf-8'))
+
+            with self.lock:
+                self.handle = None
+                if generation != self.generation:
+                    return (None, None)
+            plan.record(cmd, exit_code, stderr)
+            if exit_code != 0:
+                break
+        return (exit_code, stderr)
 
 def format_output_messages(messages):
     """Formats list of messages"""
@@ -94,10 +233,12 @@ def show_output_result_text(view, msg, text, exit_code, base_dir):
     else:
         sublime.set_timeout(lambda: sublime.status_message(msg + u" \u2717"), 0)
         if get_setting_async('show_output_window'):
+            save_output_log(ERROR_PANEL_NAME, output)
             sublime.set_timeout(lambda: write_output(view, output, base_dir), 0)
 
-def parse_output_messages_and_show(view, msg, base_dir, exit_code, stderr):
-    """Parse errors and display resulting errors"""
+def parse_output_messages_and_show(view, msg, base_dir, exit_code, stderr, source = 'build'):
+    """Parse errors and display resulting errors
+    Messages replace previous messages of source in diagnostics store"""
 
     # stderr/stdout can contain unicode characters
     stderr = stderr.decode('utf-8')
@@ -108,11 +249,123 @@ def parse_output_messages_and_show(view, msg, base_dir, exit_code, stderr):
 
     show_output_result_text(view, msg, output_text, exit_code, base_dir)
 
-    sublime.set_timeout(lambda: mark_messages_in_views(parsed_messages), 0)
+    # Messages of other projects stay
+    show_diagnostics(diagnostics.update(source, parsed_messages, directories = [base_dir]))
 
-def mark_messages_in_views(errors):
-    "Mark the regions in open views where errors were found."
-    begin_time = time.clock()
+def group_messages_by_file(messages):
+    """Group messages by normalized filename.
+    Should be called in worker thread, so that marking views is just a lookup."""
+    messages_by_file = {}
+    for m in messages:
+        messages_by_file.setdefault(os.path.abspath(m.filename), []).append(m)
+    return messages_by_file
+
+class DiagnosticsStore(object):
+    """
+    Latest messages of each source (build, check, lint) by file.
+    Messages of file are kept sorted by position to find next/previous one with binary search,
+    and counted by level for status bar.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Messages by source (dictionary: normalized filename => dictionary source => list of messages)
+        self.sources = {}
+        # Messages of all sources (dictionary: normalized filename => list of messages sorted by position)
+        self.messages = {}
+        # Positions of messages (dictionary: normalized filename => sorted list of (line, column))
+        self.positions = {}
+        # Messages count by level (dictionary: normalized filename => dictionary level => count)
+        self.counts = {}
+
+    def update(self, source, messages, files = None, directories = None):
+        """
+        Replace messages of source with new ones.
+        If files specified, messages of source are replaced only for these files and files in messages,
+        if directories specified, only for files under these directories and files in messages,
+        otherwise all messages of source are replaced.
+        Returns dictionary (normalized filename => list of all messages) for files which messages changed.
+        """
+        messages_by_file = group_messages_by_file(messages)
+        if directories is not None:
+            directories = [os.path.join(os.path.abspath(d), '') for d in directories]
+        changed = {}
+        with self.lock:
+            files_to_replace = set(messages_by_file.keys())
+            if files is None:
+                files_to_replace.update(f for f, srcs in self.sources.items() if source in srcs and
+                    (directories is None or any(f.startswith(d) for d in directories)))
+            else:
+                files_to_replace.update(os.path.abspath(f) for f in files)
+            for f in files_to_replace:
+                if f not in self.sources and f not in messages_by_file:
+                    continue
+                srcs = self.sources.setdefault(f, {})
+                if f in messages_by_file:
+                    srcs[source] = messages_by_file[f]
+                else:
+                    srcs.pop(source, None)
+                self._reindex(f)
+                changed[f] = self.messages.get(f, [])
+        return changed
+
+    def _reindex(self, filename):
+        msgs = []
+        for source_msgs in self.sources[filename].values():
+            msgs.extend(source_msgs)
+        if not msgs:
+            del self.sources[filename]
+            self.messages.pop(filename, None)
+            self.positions.pop(filename, None)
+            self.counts.pop(filename, None)
+            return
+        msgs.sort(key = lambda m: (m.line, m.column))
+        counts = {}
+        for m in msgs:
+            counts[m.level] = counts.get(m.level, 0) + 1
+        self.messages[filename] = msgs
+        self.positions[filename] = [(m.line, m.column) for m in msgs]
+        self.counts[filename] = counts
+
+    def get_messages(self, filename):
+        "Returns messages of file sorted by position"
+        with self.lock:
+            return self.messages.get(os.path.abspath(filename), [])
+
+    def get_counts(self, filename):
+        "Returns messages count by level of file"
+        with self.lock:
+            return self.counts.get(os.path.abspath(filename), {})
+
+    def find_next(self, filename, line, column, forward = True):
+        """Returns message after (or before if not forward) position, cycling at file end
+        Returns None if there are no messages"""
+        filename = os.path.abspath(filename)
+        with self.lock:
+            positions = self.positions.get(filename)
+            if not positions:
+                return None
+            if forward:
+                idx = bisect.bisect_right(positions, (line, column)) % len(positions)
+            else:
+                idx = bisect.bisect_left(positions, (line, column)) - 1
+            return self.messages[filename][idx]
+
+diagnostics = DiagnosticsStore()
+
+def show_diagnostics(messages_by_file):
+    "Mark changed messages in views, can be called from any thread"
+    sublime.set_timeout(lambda: mark_messages_in_views(messages_by_file), 0)
+
+# Marked lines of views: view id => dictionary (level => sorted list of lines)
+view_marks = {}
+
+# Name of status bar entry with messages count
+STATUS_KEY = 'sublime_haskell_diagnostics'
+
+def mark_messages_in_views(messages_by_file):
+    """Mark the regions in open views where errors were found.
+    Accepts dictionary (normalized filename => list of messages), views of other files are not touched."""
+    begin_time = time.time()
     # Mark each diagnostic in each open view in all windows:
     for w in sublime.windows():
         for v in w.views():
@@ -120,13 +373,25 @@ def mark_messages_in_views(errors):
             # Unsaved files have no file name
             if view_filename is None:
                 continue
-            errors_in_view = filter(
-                lambda x: are_paths_equal(view_filename, x.filename),
-                errors)
-            mark_messages_in_view(errors_in_view, v)
-    end_time = time.clock()
-    log('total time to mark {0} diagnostics: {1} seconds'.format(
-        len(errors), end_time - begin_time))
+            view_filename = os.path.abspath(view_filename)
+            if view_filename not in messages_by_file:
+                continue
+            errors_in_view = messages_by_file[view_filename]
+            # Nothing to mark and nothing to erase
+            if errors_in_view or v.id() in view_marks:
+                mark_messages_in_view(errors_in_view, v)
+            update_status(v)
+    metrics.record('mark diagnostics', time.time() - begin_time)
+    metrics.count('diagnostics marked', sum(len(ms) for ms in messages_by_file.values()))
+
+def update_status(view):
+    "Show messages count of view's file in status bar"
+    counts = diagnostics.get_counts(view.file_name())
+    if not counts:
+        view.erase_status(STATUS_KEY)
+        return
+    view.set_status(STATUS_KEY, u', '.join(
+        u'{0} {1}s'.format(counts[level], level) for level in ['error', 'warning', 'hint'] if level in counts))
 
 message_levels = {
     'hint': {
@@ -147,41 +412,88 @@ def region_key(name):
     return 'subhs-{0}s'.format(name)
 
 def mark_messages_in_view(messages, view):
-    # Regions by level
-    regions = {}
+    """Update marked regions of view, touching only levels whose set of marked lines changed.
+    Regions of lines which are still marked are kept as is."""
+    # Messages by level and line, one region per line
+    messages_by_line = {}
     for k in message_levels.keys():
-        regions[k] = []
+        messages_by_line[k] = {}
 
     for m in messages:
-        regions[m.level].append(m.find_region_in_view(view))
+        messages_by_line[m.level].setdefault(m.line, m)
 
+    marks = {}
     for nm, lev in message_levels.items():
-        view.erase_regions(region_key(nm))
+        key = region_key(nm)
+        lines = sorted(messages_by_line[nm].keys())
+        if lines:
+            marks[nm] = lines
+
+        # Sublime moves regions while text is edited, so compare by their current lines
+        current_regions = {}
+        for r in view.get_regions(key):
+            current_regions[view.rowcol(r.begin())[0] + 1] = r
+
+        if sorted(current_regions.keys()) == lines:
+            continue
+
+        if not lines:
+            view.erase_regions(key)
+            continue
+
+        regions = []
+        for l in lines:
+            if l in current_regions:
+                regions.append(current_regions[l])
+            else:
+                regions.append(messages_by_line[nm][l].find_region_in_view(view))
+
         view.add_regions(
-            region_key(nm),
-            regions[nm],
+            key,
+            regions,
             lev['style'],
             lev['icon'],
             sublime.DRAW_OUTLINED)
 
+    if marks:
+        view_marks[view.id()] = marks
+    else:
+        view_marks.pop(view.id(), None)
+
+class SublimeHaskellMarksListener(sublime_plugin.EventListener):
+    def on_load(self, view):
+        # Mark known messages without running tools again
+        messages = diagnostics.get_messages(view.file_name())
+        if messages:
+            mark_messages_in_view(messages, view)
+            update_status(view)
+
+    def on_close(self, view):
+        view_marks.pop(view.id(), None)
+
+class SublimeHaskellNextError(sublime_plugin.TextCommand):
+    "Move cursor to next (or previous if forward is false) message in file"
+    def run(self, edit, forward = True):
+        view = self.view
+        row, col = view.rowcol(view.sel()[0].begin())
+        msg = diagnostics.find_next(view.file_name(), row + 1, col + 1, forward)
+        if msg is None:
+            sublime.status_message('SublimeHaskell: No errors or warnings')
+            return
+        point = view.text_point(msg.line - 1, msg.column - 1)
+        view.sel().clear()
+        view.sel().add(sublime.Region(point))
+        view.show(point)
+        sublime.status_message(u'SublimeHaskell: {0}'.format(msg.message.splitlines()[0]))
+
+    def is_enabled(self):
+        return self.view.file_name() is not None
+
 def write_output(view, text, cabal_project_dir):
     "Write text to Sublime's output panel."
-    output_view = view.window().get_output_panel(ERROR_PANEL_NAME)
-    output_view.set_read_only(False)
-    # Configure Sublime's error message parsing:
-    output_view.settings().set("result_file_regex", result_file_regex)
-    output_view.settings().set("result_base_dir", cabal_project_dir)
-    # Write to the output buffer:
-    edit = output_view.begin_edit()
-    #output_view.insert(edit, 0, text)
-    output_view.insert(edit, output_view.size(), text)
-    output_view.end_edit(edit)
-    # Set the selection to the beginning of the view so that "next result" works:
-    output_view.sel().clear()
-    output_view.sel().add(sublime.Region(0))
-    output_view.set_read_only(True)
-    # Show the results panel:
-    view.window().run_command('show_panel', {'panel': 'output.' + ERROR_PANEL_NAME})
+    write_panel(view.window(), ERROR_PANEL_NAME, text, {
+        'result_file_regex': result_file_regex,
+        'result_base_dir': cabal_project_dir })
 
 def hide_output(view):
     view.window().run_command('hide_panel', {'panel': 'output.' + ERROR_PANEL_NAME})
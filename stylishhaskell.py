@@ -1,32 +1,93 @@
+import difflib
 import errno
 import sublime
 import sublime_plugin
+from threading import Thread
 
-from sublime_haskell_common import log, is_enabled_haskell_command, call_and_wait_with_input
+from sublime_haskell_common import log, is_enabled_haskell_command, call_and_wait_with_input, get_tool_environment, PRIORITY_INTERACTIVE
+
+def get_stylish_regions(view):
+    """
+    Returns sorted list of distinct (begin, end) regions to stylish, one for each selection.
+    Empty selection means whole file, overlapping selections are merged.
+    """
+    regions = []
+    for region in view.sel():
+        if region.empty():
+            return [(0, view.size())]
+        regions.append((region.begin(), region.end()))
+    regions.sort()
+    merged = []
+    for (begin, end) in regions:
+        if merged and begin <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((begin, end))
+    return merged
+
+def diff_lines(old_text, new_text):
+    """
+    Returns list of (begin, end, replacement) changes, which turn old_text into new_text.
+    Changes are made of whole lines, begin and end are offsets in old_text.
+    """
+    old_lines = old_text.splitlines(True)
+    new_lines = new_text.splitlines(True)
+    # Offsets of old lines
+    offsets = [0]
+    for line in old_lines:
+        offsets.append(offsets[-1] + len(line))
+    changes = []
+    for (tag, i1, i2, j1, j2) in difflib.SequenceMatcher(None, old_lines, new_lines, False).get_opcodes():
+        if tag != 'equal':
+            changes.append((offsets[i1], offsets[i2], ''.join(new_lines[j1:j2])))
+    return changes
 
 class SublimeHaskellStylish(sublime_plugin.TextCommand):
+    """
+    Runs stylish-haskell on selections (or whole file) in background.
+    Only changed lines are replaced, so folds and marks of other lines are kept.
+    Result is dropped if buffer changes while stylish-haskell runs.
+    """
     def run(self, edit):
-        try:
-            regions = []
-            for region in self.view.sel():
-                regions.append(sublime.Region(region.a, region.b))
-                if region.empty():
-                    selection = sublime.Region(0, self.view.size())
-                else:
-                    selection = region
-                sel_str = self.view.substr(selection).replace('\r\n', '\n')
-                exit_code, out, err = call_and_wait_with_input(['stylish-haskell'], sel_str)
-                out_str = out.replace('\r\n', '\n')
-                if exit_code == 0 and out_str != sel_str:
-                    self.view.replace(edit, selection, out_str)
-
-            self.view.sel().clear()
-            for region in regions:
-                self.view.sel().add(region)
+        view = self.view
+        regions = get_stylish_regions(view)
+        snapshot = [(begin, end, view.substr(sublime.Region(begin, end))) for (begin, end) in regions]
+        change_count = view.change_count()
+        sublime.status_message("SublimeHaskell: Running stylish-haskell...")
+        Thread(target=self.stylish, args=(change_count, snapshot)).start()
 
+    def stylish(self, change_count, snapshot):
+        changes = []
+        try:
+            for (begin, end, text) in snapshot:
+                sel_str = text.replace('\r\n', '\n')
+                exit_code, out, err = call_and_wait_with_input(['stylish-haskell'], sel_str.encode('utf-8'), PRIORITY_INTERACTIVE)
+                if exit_code != 0:
+                    log('stylish-haskell failed: {0}'.format(err))
+                    continue
+                out_str = out.decode('utf-8').replace('\r\n', '\n')
+                for (change_begin, change_end, replacement) in diff_lines(sel_str, out_str):
+                    changes.append((begin + change_begin, begin + change_end, replacement))
         except OSError, e:
-            if e.errno == errno.ENOENT:
-                sublime.error_message("SublimeHaskell: stylisg-haskell was not found!")
+            if e.errno == errno.ENOENT and get_tool_environment().report_missing('stylish-haskell'):
+                sublime.set_timeout(lambda: sublime.error_message("SublimeHaskell: stylish-haskell was not found!"), 0)
+            return
+        sublime.set_timeout(lambda: self.apply_changes(change_count, changes), 0)
+
+    def apply_changes(self, change_count, changes):
+        view = self.view
+        if view.change_count() != change_count:
+            sublime.status_message("SublimeHaskell: File changed, stylish-haskell result is not applied")
+            return
+        if not changes:
+            sublime.status_message("SublimeHaskell: Nothing to stylish")
+            return
+        stylish_edit = view.begin_edit()
+        # Apply from the end, so that offsets of remaining changes are valid
+        for (begin, end, replacement) in sorted(changes, reverse=True):
+            view.replace(stylish_edit, sublime.Region(begin, end), replacement)
+        view.end_edit(stylish_edit)
+        sublime.status_message("SublimeHaskell: stylish-haskell changed {0} blocks of lines".format(len(changes)))
 
     def is_enabled(self):
         return is_enabled_haskell_command(False)
@@ -1,9 +1,18 @@
+import bisect
+import codecs
+import collections
 import errno
 import fnmatch
+import hashlib
+import json
+import math
 import os
+import re
 import sublime
 import sublime_plugin
 import subprocess
+import threading
+import time
 
 # Maximum seconds to wait for window to appear
 # This dirty hack is used in wait_for_window function
@@ -15,26 +24,49 @@ PACKAGE_PATH = os.path.join(sublime.packages_path(), 'SublimeHaskell')
 # Panel for SublimeHaskell errors
 SUBLIME_ERROR_PANEL_NAME = 'haskell_sublime_load'
 
+# Full output of panels is saved here
+OUTPUT_LOG_DIR = os.path.join(PACKAGE_PATH, 'logs')
+
 # Setting can't be get from not main threads
 # So we using a trick:
-# Once setting loaded from main thread, it also stored in sublime_haskell_settings dictionary
-# and callback attached to update its value
+# Once setting loaded from main thread, it also stored in settings snapshot
+# and snapshot is refreshed in main thread when settings change
 # And then setting can be get from any thread with get_setting_async
 # But setting must be loaded at least once from main thread
 # Some settings are loaded only from secondary threads, so we loading them here for first time
 class SublimeHaskellSettingsLoader(sublime_plugin.EventListener):
     def __init__(self):
-        # Now we can use get_setting_async for 'add_to_PATH' safely
-        get_setting('add_to_PATH')
-        get_setting('use_cabal_dev')
-        get_setting('cabal_dev_sandbox')
-        get_setting('cabal_dev_sandbox_list')
-        get_setting('enable_auto_build')
-        get_setting('show_output_window')
-
-# SublimeHaskell settings dictionary
+        # Now we can use get_setting_async for all settings of package safely
+        for key in get_default_setting_keys():
+            get_setting(key)
+        # State built before settings were loaded (e.g. tool environment without 'add_to_PATH') is stale
+        refresh_settings_snapshot()
+        get_settings().add_on_change('sublime_haskell_settings_snapshot', refresh_settings_snapshot)
+        threading.Thread(target=check_tools).start()
+
+def get_default_setting_keys():
+    "Returns keys of default settings file of package"
+    try:
+        with open(os.path.join(PACKAGE_PATH, 'SublimeHaskell.sublime-settings')) as f:
+            # Settings file is JSON with line comments
+            return json.loads(re.sub(r'(?m)^\s*//.*$', '', f.read())).keys()
+    except (IOError, ValueError), e:
+        log('can\'t read default settings: {0}'.format(e))
+        return []
+
+class SettingsSnapshot(object):
+    """
+    Values of settings loaded from main thread, never modified after creation.
+    Main thread replaces snapshot with a new one, so any thread can read it without locking.
+    Version is incremented every time settings change.
+    """
+    def __init__(self, version, values):
+        self.version = version
+        self.values = values
+
+# SublimeHaskell settings snapshot
 # used to retrieve it async from any thread
-sublime_haskell_settings = {}
+settings_snapshot = SettingsSnapshot(0, {})
 
 # Base command
 class SublimeHaskellBaseCommand(sublime_plugin.WindowCommand):
@@ -75,34 +107,369 @@ def get_haskell_command_window_view_file_project():
         file_name = view.file_name()
     return window, view, file_name
 
-def call_and_wait(command, **popen_kwargs):
-    return call_and_wait_with_input(command, None, **popen_kwargs)
+def call_and_wait(command, priority = None, handle = None, timeout = None, **popen_kwargs):
+    return call_and_wait_with_input(command, None, priority, handle, timeout, **popen_kwargs)
 
-def call_and_wait_with_input(command, input_string, **popen_kwargs):
+def call_and_wait_with_input(command, input_string, priority = None, handle = None, timeout = None, **popen_kwargs):
     """Run the specified command, block until it completes, and return
     the exit code, stdout, and stderr.
+    Command is run by process_executor with priority (PRIORITY_BACKGROUND by default),
+    see ProcessExecutor.run for handle and timeout.
     Extends os.environment['PATH'] with the 'add_to_PATH' setting.
     Additional parameters to Popen can be specified as keyword parameters."""
+    if priority is None:
+        priority = PRIORITY_BACKGROUND
+    return process_executor.run(command, priority, input_string, handle, timeout, **popen_kwargs)
+
+def call_no_wait(command, **popen_kwargs):
+    """Start the specified command and return the Popen object without waiting.
+    Used when the caller needs the process itself, e.g. to kill it.
+    Tool is resolved to absolute path with PATH extended by the 'add_to_PATH' setting,
+    OSError with ENOENT is raised if it is not found."""
     if subprocess.mswindows:
         startupinfo = subprocess.STARTUPINFO()
         startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
         popen_kwargs['startupinfo'] = startupinfo
 
-    # For the subprocess, extend the env PATH to include the 'add_to_PATH' setting.
-    extended_env = dict(os.environ)
-    PATH = os.getenv('PATH') or ""
-    extended_env['PATH'] = ':'.join(get_setting_async('add_to_PATH', []) + [PATH])
-
-    process = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        stdin=subprocess.PIPE,
-        env=extended_env,
-        **popen_kwargs)
-    stdout, stderr = process.communicate(input_string)
-    exit_code = process.wait()
-    return (exit_code, stdout, stderr)
+    tools = get_tool_environment()
+    executable = tools.find_tool(command[0])
+    if executable is None:
+        raise OSError(errno.ENOENT, '{0} was not found'.format(command[0]))
+
+    # Pipes can be overridden, e.g. stderr=subprocess.STDOUT
+    kwargs = {
+        'stdout': subprocess.PIPE,
+        'stderr': subprocess.PIPE,
+        'stdin': subprocess.PIPE,
+        'env': tools.env }
+    kwargs.update(popen_kwargs)
+    return subprocess.Popen([executable] + list(command[1:]), **kwargs)
+
+def find_executable(name, path):
+    "Returns absolute path of executable, searching in directories of path, or None if it is not found"
+    extensions = ['']
+    if subprocess.mswindows:
+        extensions.extend(os.getenv('PATHEXT', '.EXE').lower().split(os.pathsep))
+    if os.path.dirname(name):
+        dirs = ['']
+    else:
+        dirs = path.split(os.pathsep)
+    for d in dirs:
+        for ext in extensions:
+            candidate = os.path.join(d, name + ext)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return os.path.abspath(candidate)
+    return None
+
+# Tools, which are checked on startup and when settings of tools change
+CHECKED_TOOLS = ['ghc', 'ghc-mod', 'cabal', 'stylish-haskell']
+# Settings, which change paths of tools
+TOOL_SETTINGS = ['add_to_PATH', 'use_cabal_dev']
+
+class ToolEnvironment(object):
+    """
+    Environment of tool processes with resolved paths and versions of tools.
+    Made for one settings version, so that it's not rebuilt for every process.
+    """
+    def __init__(self, version):
+        self.version = version
+        # For the subprocess, extend the env PATH to include the 'add_to_PATH' setting.
+        self.env = dict(os.environ)
+        PATH = os.getenv('PATH') or ""
+        self.env['PATH'] = os.pathsep.join(get_setting_async('add_to_PATH', []) + [PATH])
+        self.lock = threading.Lock()
+        # Absolute paths of tools found in PATH by bare name, None for not found ones
+        self.paths = {}
+        # First lines of `tool --version` output
+        self.versions = {}
+        # Tools reported as missing
+        self.reported = set()
+
+    def find_tool(self, name):
+        "Returns absolute path of tool or None if it is not found"
+        # Paths (e.g. built executable, inspectors) are checked every time, they can appear later
+        if os.path.dirname(name):
+            return find_executable(name, self.env['PATH'])
+        with self.lock:
+            if name in self.paths:
+                return self.paths[name]
+        path = find_executable(name, self.env['PATH'])
+        with self.lock:
+            self.paths[name] = path
+        return path
+
+    def get_version(self, name):
+        "Returns version string of tool or None if it is unknown, must be called from worker thread"
+        with self.lock:
+            if name in self.versions:
+                return self.versions[name]
+        version = None
+        try:
+            exit_code, out, err = call_and_wait([name, '--version'])
+            if exit_code == 0 and out.strip():
+                version = out.strip().splitlines()[0]
+        except OSError:
+            pass
+        with self.lock:
+            self.versions[name] = version
+        return version
+
+    def report_missing(self, name):
+        "Returns True only first time for each tool, so that missing tool is reported once"
+        with self.lock:
+            if name in self.reported:
+                return False
+            self.reported.add(name)
+            return True
+
+tool_environment = None
+
+def get_tool_environment():
+    "Returns tool environment for current settings, can be called from any thread"
+    global tool_environment
+    tools = tool_environment
+    if tools is None or tools.version != get_settings_version():
+        tools = ToolEnvironment(get_settings_version())
+        tool_environment = tools
+    return tools
+
+def check_tools():
+    "Log paths and versions of tools and report missing ones, must be called from worker thread"
+    tools = get_tool_environment()
+    names = list(CHECKED_TOOLS)
+    if get_setting_async('use_cabal_dev'):
+        names.append('cabal-dev')
+    missing = []
+    for name in names:
+        path = tools.find_tool(name)
+        if path is None:
+            missing.append(name)
+        else:
+            log(u'{0} ({1}): {2}'.format(name, path, tools.get_version(name) or 'unknown version'))
+    if missing:
+        message = u'{0} not found, try adjusting the \'add_to_PATH\' setting'.format(', '.join(missing))
+        log(message)
+        sublime.set_timeout(lambda: sublime.status_message(u'SublimeHaskell: ' + message), 0)
+
+# Priorities of processes, waiting processes with lower value are started first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_CHECK = 1
+PRIORITY_BUILD = 2
+PRIORITY_BACKGROUND = 3
+
+# Niceness of background processes
+BACKGROUND_NICENESS = 10
+# Windows process priority class of background processes
+BELOW_NORMAL_PRIORITY_CLASS = 0x00004000
+
+def lower_process_priority(popen_kwargs):
+    "Update Popen arguments to run process with lowered OS priority"
+    if subprocess.mswindows:
+        popen_kwargs['creationflags'] = popen_kwargs.get('creationflags', 0) | BELOW_NORMAL_PRIORITY_CLASS
+    else:
+        popen_kwargs['preexec_fn'] = lambda: os.nice(BACKGROUND_NICENESS)
+
+def get_tool_name(command):
+    "Returns name of tool, which is run by command, e.g. 'ghc-mod'"
+    return os.path.splitext(os.path.basename(command[0]))[0]
+
+def kill_process(process):
+    try:
+        process.kill()
+    except OSError:
+        # Already terminated
+        pass
+
+class ProcessHandle(object):
+    """
+    Cancellation handle of process run by process_executor.
+    Cancelling kills process, or drops it from queue if it is not started yet.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.timed_out = False
+        self.process = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            process = self.process
+        if process is not None:
+            kill_process(process)
+        process_executor.wake()
+
+    def set_process(self, process):
+        "Attach started process, it is killed at once if handle is already cancelled"
+        with self.lock:
+            self.process = process
+            cancelled = self.cancelled
+        if cancelled:
+            kill_process(process)
+
+class ProcessExecutor(object):
+    """
+    Starts processes of all tools.
+    At most 'max_processes' processes run at once, and at most 'process_limits'[tool] processes of each tool.
+    Waiting processes are started in order of priority.
+    Process is killed after timeout, by default 'process_timeouts'[tool] seconds (no timeout if not set).
+    Background processes run with lowered OS priority, so that they don't slow down the editor.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Number of running processes of each tool
+        self.running = {}
+        # Sorted waiting requests: (priority, sequence number, tool)
+        self.waiting = []
+        self.sequence = 0
+        # Started processes (dictionary: process => (tool, timeout timer))
+        self.processes = {}
+
+    def wake(self):
+        "Wake up waiting requests to check for cancellation"
+        with self.condition:
+            self.condition.notify_all()
+
+    def is_tool_free(self, tool):
+        "Must be called with condition held"
+        if sum(self.running.values()) >= get_setting_async('max_processes', 8):
+            return False
+        limit = get_setting_async('process_limits', {}).get(tool)
+        return limit is None or self.running.get(tool, 0) < limit
+
+    def can_start(self, request):
+        "Request can start if there is free slot and no request with higher priority can take it, must be called with condition held"
+        for waiting in self.waiting:
+            if waiting >= request:
+                break
+            if self.is_tool_free(waiting[2]):
+                return False
+        return self.is_tool_free(request[2])
+
+    def start(self, command, priority, handle = None, timeout = None, **popen_kwargs):
+        """
+        Wait for free slot and start command, returns Popen object
+        or None if handle was cancelled before process started.
+        release(process) must be called when process terminates.
+        """
+        tool = get_tool_name(command)
+        if priority == PRIORITY_BACKGROUND:
+            lower_process_priority(popen_kwargs)
+        with self.condition:
+            self.sequence += 1
+            request = (priority, self.sequence, tool)
+            bisect.insort(self.waiting, request)
+            try:
+                while not (handle and handle.cancelled) and not self.can_start(request):
+                    self.condition.wait()
+            finally:
+                self.waiting.remove(request)
+                # Requests with lower priority could wait for this one
+                self.condition.notify_all()
+            if handle and handle.cancelled:
+                return None
+            self.running[tool] = self.running.get(tool, 0) + 1
+
+        try:
+            process = call_no_wait(command, **popen_kwargs)
+        except:
+            with self.condition:
+                self.running[tool] -= 1
+                self.condition.notify_all()
+            raise
+
+        if timeout is None:
+            timeout = get_setting_async('process_timeouts', {}).get(tool)
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, lambda: self.on_timeout(process, handle, command, timeout))
+            timer.daemon = True
+            timer.start()
+        with self.condition:
+            self.processes[process] = (tool, timer)
+        if handle:
+            handle.set_process(process)
+        return process
+
+    def on_timeout(self, process, handle, command, timeout):
+        with self.condition:
+            if process not in self.processes:
+                return
+            kill_process(process)
+        if handle:
+            handle.timed_out = True
+        log('{0} killed after {1} seconds timeout'.format(' '.join(command), timeout))
+
+    def release(self, process):
+        "Free slot of terminated process"
+        with self.condition:
+            (tool, timer) = self.processes.pop(process)
+            self.running[tool] -= 1
+            self.condition.notify_all()
+        if timer:
+            timer.cancel()
+
+    def run(self, command, priority, input_string = None, handle = None, timeout = None, **popen_kwargs):
+        """
+        Run command, block until it completes, and return the exit code, stdout, and stderr.
+        Returns (None, '', '') if handle was cancelled before process started.
+        """
+        begin_time = time.time()
+        process = self.start(command, priority, handle, timeout, **popen_kwargs)
+        if process is None:
+            return (None, '', '')
+        start_time = time.time()
+        try:
+            stdout, stderr = process.communicate(input_string)
+            exit_code = process.wait()
+        finally:
+            self.release(process)
+        name = get_command_metric_name(command)
+        metrics.record('wait: ' + name, start_time - begin_time)
+        metrics.record(name, time.time() - start_time)
+        if exit_code != 0:
+            metrics.count('failed: ' + name)
+        if handle and handle.timed_out:
+            metrics.count('timed out: ' + name)
+        return (exit_code, stdout, stderr)
+
+process_executor = ProcessExecutor()
+
+def get_command_metric_name(command):
+    "Name of command in metrics: tool name and subcommand, e.g. 'ghc-mod check' or 'cabal build'"
+    tool = get_tool_name(command)
+    if tool in ['ghc-mod', 'cabal', 'cabal-dev']:
+        for arg in command[1:]:
+            if not arg.startswith('-'):
+                return u'{0} {1}'.format(tool, arg)
+    return tool
+
+class ActivityGovernor(object):
+    """
+    Tracks typing of user, so that background work pauses while user types
+    and resumes when editor is idle for 'background_idle_delay' milliseconds.
+    """
+    def __init__(self):
+        self.last_activity = 0.0
+
+    def touch(self):
+        "Report user activity"
+        self.last_activity = time.time()
+
+    def wait_for_idle(self):
+        "Block until user stops typing, must be called from worker thread"
+        while True:
+            delay = get_setting_async('background_idle_delay', 1000) / 1000.0
+            remaining = self.last_activity + delay - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+activity_governor = ActivityGovernor()
+
+class SublimeHaskellActivityListener(sublime_plugin.EventListener):
+    def on_modified(self, view):
+        activity_governor.touch()
 
 def log(message):
     print(u'Sublime Haskell: {0}'.format(message))
@@ -175,6 +542,160 @@ def are_paths_equal(path, other_path):
     other_path = os.path.abspath(other_path)
     return path == other_path
 
+# Content hashes of files: filename => (modification time, size, hash)
+file_hashes_lock = threading.Lock()
+file_hashes = {}
+
+def get_file_hash(filename):
+    """Return md5 hex digest of file contents.
+    File is read again only if its modification time or size changed."""
+    st = os.stat(filename)
+    with file_hashes_lock:
+        cached = file_hashes.get(filename)
+    hit = cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size
+    metrics.cache_access('file hashes', hit)
+    if hit:
+        return cached[2]
+    with open(filename, 'rb') as f:
+        digest = hashlib.md5(f.read()).hexdigest()
+    with file_hashes_lock:
+        file_hashes[filename] = (st.st_mtime, st.st_size, digest)
+    return digest
+
+# Number of latest samples of each latency, percentiles are computed from
+METRIC_SAMPLES = 1000
+
+def percentile(sorted_samples, p):
+    "Nearest-rank percentile of sorted list of samples"
+    index = int(math.ceil(p / 100.0 * len(sorted_samples))) - 1
+    return sorted_samples[max(0, index)]
+
+class Metrics(object):
+    """
+    Counters, latencies (in seconds) and cache statistics of plugin operations.
+    Can be used from any thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # name => value
+        self.counters = {}
+        # name => (count, total, max, deque of last samples)
+        self.latencies = {}
+        # name => [hits, misses]
+        self.cache_accesses = {}
+        # name => function returning number of entries
+        self.cache_sizes = {}
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, seconds):
+        with self.lock:
+            (count, total, maximum, samples) = self.latencies.get(name, (0, 0.0, 0.0, None))
+            if samples is None:
+                samples = collections.deque(maxlen = METRIC_SAMPLES)
+            samples.append(seconds)
+            self.latencies[name] = (count + 1, total + seconds, max(maximum, seconds), samples)
+
+    def cache_access(self, name, hit):
+        with self.lock:
+            accesses = self.cache_accesses.setdefault(name, [0, 0])
+            accesses[0 if hit else 1] += 1
+
+    def register_cache(self, name, size_function):
+        with self.lock:
+            self.cache_sizes[name] = size_function
+
+    def snapshot(self):
+        "Returns all metrics as dictionary, which can be dumped as JSON"
+        with self.lock:
+            counters = dict(self.counters)
+            latencies = [(name, count, total, maximum, sorted(samples)) for (name, (count, total, maximum, samples)) in self.latencies.items()]
+            cache_accesses = dict((name, list(accesses)) for (name, accesses) in self.cache_accesses.items())
+            cache_sizes = list(self.cache_sizes.items())
+        result = {
+            'uptime': time.time() - self.started,
+            'counters': counters,
+            'latencies': {},
+            'caches': {} }
+        for (name, count, total, maximum, samples) in latencies:
+            result['latencies'][name] = {
+                'count': count,
+                'mean': total / count,
+                'p50': percentile(samples, 50),
+                'p95': percentile(samples, 95),
+                'p99': percentile(samples, 99),
+                'max': maximum }
+        for (name, size_function) in cache_sizes:
+            result['caches'][name] = { 'size': size_function() }
+        for (name, (hits, misses)) in cache_accesses.items():
+            cache = result['caches'].setdefault(name, {})
+            cache['hits'] = hits
+            cache['misses'] = misses
+            cache['hit_rate'] = float(hits) / (hits + misses) if hits + misses else None
+        return result
+
+    def format(self):
+        "Returns metrics as text table"
+        stats = self.snapshot()
+        lines = [u'Uptime: {0:.0f} seconds'.format(stats['uptime']), u'']
+        lines.append(u'{0:<40} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9}'.format('Latency (ms)', 'count', 'mean', 'p50', 'p95', 'p99', 'max'))
+        for (name, l) in sorted(stats['latencies'].items()):
+            lines.append(u'{0:<40} {1:>8} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>9.1f}'.format(
+                name, l['count'], l['mean'] * 1000, l['p50'] * 1000, l['p95'] * 1000, l['p99'] * 1000, l['max'] * 1000))
+        lines.append(u'')
+        lines.append(u'{0:<40} {1:>8} {2:>9} {3:>9} {4:>9}'.format('Cache', 'size', 'hits', 'misses', 'hit rate'))
+        for (name, c) in sorted(stats['caches'].items()):
+            hit_rate = c.get('hit_rate')
+            lines.append(u'{0:<40} {1:>8} {2:>9} {3:>9} {4:>9}'.format(
+                name, c.get('size', '-'), c.get('hits', '-'), c.get('misses', '-'),
+                '{0:.1%}'.format(hit_rate) if hit_rate is not None else '-'))
+        lines.append(u'')
+        lines.append(u'{0:<40} {1:>8}'.format('Counter', 'value'))
+        for (name, value) in sorted(stats['counters'].items()):
+            lines.append(u'{0:<40} {1:>8}'.format(name, value))
+        return u'\n'.join(lines) + u'\n'
+
+metrics = Metrics()
+metrics.register_cache('file hashes', lambda: len(file_hashes))
+
+class BoundedCache(object):
+    """
+    Thread-safe dictionary, which drops oldest entries when it holds more than size of them
+    Hits and size of cache with name are reported to metrics.
+    """
+    def __init__(self, size, name = None):
+        self.size = size
+        self.name = name
+        self.lock = threading.Lock()
+        self.values = {}
+        # keys from oldest to newest
+        self.keys = []
+        if name:
+            metrics.register_cache(name, self.__len__)
+
+    def get(self, key, default = None):
+        with self.lock:
+            hit = key in self.values
+            value = self.values.get(key, default)
+        if self.name:
+            metrics.cache_access(self.name, hit)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key not in self.values:
+                self.keys.append(key)
+            self.values[key] = value
+            while len(self.keys) > self.size:
+                del self.values[self.keys.pop(0)]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.values)
+
 def attach_sandbox(cmd):
     """Attach sandbox arguments to command"""
     sand = get_setting_async('cabal_dev_sandbox')
@@ -196,36 +717,50 @@ def save_settings():
 
 def get_setting(key, default=None):
     "This should be used only from main thread"
-    # Get setting
-    result = get_settings().get(key, default)
-    # Key was not retrieved, save its value and add callback to auto-update
-    if key not in sublime_haskell_settings:
-        sublime_haskell_settings[key] = result
-        get_settings().add_on_change(key, lambda: update_setting(key))
+    global settings_snapshot
+    settings = get_settings()
+    result = settings.get(key, default)
+    # Key was not retrieved, add it to snapshot to make it available for get_setting_async
+    if key not in settings_snapshot.values:
+        values = dict(settings_snapshot.values)
+        values[key] = settings.get(key)
+        settings_snapshot = SettingsSnapshot(settings_snapshot.version, values)
     return result
 
-def update_setting(key):
-    "Updates setting as it was changed"
-    sublime_haskell_settings[key] = get_setting(key)
+def refresh_settings_snapshot():
+    "Reloads values of all loaded settings as they were changed, must be called from main thread"
+    global settings_snapshot
+    settings = get_settings()
+    values = {}
+    for key in settings_snapshot.values:
+        values[key] = settings.get(key)
+    tools_changed = any(values.get(key) != settings_snapshot.values.get(key) for key in TOOL_SETTINGS)
+    settings_snapshot = SettingsSnapshot(settings_snapshot.version + 1, values)
+    if tools_changed:
+        threading.Thread(target=check_tools).start()
 
 def get_setting_async(key, default=None):
     """
     Get setting from any thread
     Note, that setting must be loaded before by get_setting from main thread
+    Returned value must not be modified
     """
-    # Reload it in main thread for future calls of get_setting_async
-    sublime.set_timeout(lambda: update_setting(key), 0)
-    if key not in sublime_haskell_settings:
-        # Load it in main thread, but for now all we can do is result default
+    value = settings_snapshot.values.get(key)
+    if value is None:
         return default
-    return sublime_haskell_settings[key]
+    return value
+
+def get_settings_version():
+    "Returns version of settings, which changes every time settings change, can be called from any thread"
+    return settings_snapshot.version
 
 def set_setting(key, value):
-    """Set setting and update dictionary"""
-    sublime_haskell_settings[key] = value
+    """Set setting and update snapshot"""
     get_settings().set(key, value)
+    get_setting(key)
+    refresh_settings_snapshot()
 
-def call_ghcmod_and_wait(arg_list, file_dir = None):
+def call_ghcmod_and_wait(arg_list, file_dir = None, priority = None):
     """
     Calls ghc-mod with the given arguments.
     Shows a sublime error message if ghc-mod is not available.
@@ -233,6 +768,7 @@ def call_ghcmod_and_wait(arg_list, file_dir = None):
     try:
         exit_code, out, err = call_and_wait(
             try_attach_sandbox(['ghc-mod'] + arg_list),
+            priority,
             cwd = file_dir)
 
         if exit_code != 0:
@@ -241,12 +777,13 @@ def call_ghcmod_and_wait(arg_list, file_dir = None):
         return out
 
     except OSError, e:
-        if e.errno == errno.ENOENT:
-            sublime.error_message("SublimeHaskell: ghc-mod was not found!\n"
+        if e.errno == errno.ENOENT and get_tool_environment().report_missing('ghc-mod'):
+            # Usually called from worker thread
+            sublime.set_timeout(lambda: sublime.error_message("SublimeHaskell: ghc-mod was not found!\n"
                 + "It is used for LANGUAGE and import autocompletions "
                 + "and type inference.\n"
                 + "Try adjusting the 'add_to_PATH' setting.\n"
-                + "You can also turn this off using the 'enable_ghc_mod' setting.")
+                + "You can also turn this off using the 'enable_ghc_mod' setting."), 0)
 
 def wait_for_window_callback(on_appear, seconds_to_wait):
     window = sublime.active_window()
@@ -278,3 +815,104 @@ def output_error(window, text):
     output_view.set_read_only(True)
 
     window.run_command('show_panel', {'panel': 'output.' + SUBLIME_ERROR_PANEL_NAME})
+
+# Generation of chunked output for each panel, older outputs stop writing when new one starts
+output_panel_generations = {}
+
+# Log file of last output written to a panel
+last_output_log = None
+
+def get_output_log_path(panel_name):
+    return os.path.join(OUTPUT_LOG_DIR, panel_name + '.log')
+
+def open_output_log(panel_name):
+    """Open log file of panel output for writing, can be called from any thread.
+    Returns file object."""
+    global last_output_log
+    if not os.path.exists(OUTPUT_LOG_DIR):
+        os.makedirs(OUTPUT_LOG_DIR)
+    log_path = get_output_log_path(panel_name)
+    f = codecs.open(log_path, 'w', 'utf-8')
+    last_output_log = log_path
+    return f
+
+def save_output_log(panel_name, text):
+    """Save full text of panel output to log file, can be called from any thread.
+    Returns log file path."""
+    with open_output_log(panel_name) as f:
+        f.write(text)
+    return get_output_log_path(panel_name)
+
+def write_panel(window, panel_name, text, panel_settings = {}):
+    """
+    Write text to output panel and show it.
+    Text is truncated to 'output_panel_max_size' characters and inserted in chunks
+    of 'output_panel_chunk_size' characters, so that huge output doesn't freeze the editor.
+    Full text should be saved with save_output_log.
+    panel_settings are set to panel view settings (result_file_regex, result_base_dir).
+    """
+    max_size = get_setting('output_panel_max_size', 500000)
+    chunk_size = max(1, get_setting('output_panel_chunk_size', 20000))
+
+    if len(text) > max_size:
+        # Cut on line boundary, so that the last shown message is not broken
+        cut = text.rfind(u'\n', 0, max_size)
+        if cut <= 0:
+            cut = max_size
+        text = u'{0}\n\n... {1} more characters not shown, run "SublimeHaskell: Open Full Log" to see the whole output'.format(
+            text[0:cut], len(text) - cut)
+
+    generation = output_panel_generations.get(panel_name, 0) + 1
+    output_panel_generations[panel_name] = generation
+
+    output_view = window.get_output_panel(panel_name)
+    # Configure Sublime's error message parsing:
+    for k, v in panel_settings.items():
+        output_view.settings().set(k, v)
+
+    def write_chunk(offset):
+        # Other output started
+        if output_panel_generations.get(panel_name) != generation:
+            return
+        output_view.set_read_only(False)
+        edit = output_view.begin_edit()
+        output_view.insert(edit, output_view.size(), text[offset:offset + chunk_size])
+        output_view.end_edit(edit)
+        output_view.set_read_only(True)
+        if offset + chunk_size < len(text):
+            # Let the editor process events before next chunk
+            sublime.set_timeout(lambda: write_chunk(offset + chunk_size), 1)
+
+    write_chunk(0)
+    # Set the selection to the beginning of the view so that "next result" works:
+    output_view.sel().clear()
+    output_view.sel().add(sublime.Region(0))
+    # Show the results panel:
+    window.run_command('show_panel', {'panel': 'output.' + panel_name})
+
+class SublimeHaskellShowStats(sublime_plugin.WindowCommand):
+    """
+    Show latencies, cache hit rates and counters of plugin.
+    With as_json argument set, stats are dumped as JSON to new view.
+    """
+    def run(self, as_json = False):
+        if not as_json:
+            write_panel(self.window, 'sublime_haskell_stats', metrics.format())
+            return
+        view = self.window.new_file()
+        view.set_name('SublimeHaskell stats.json')
+        view.set_scratch(True)
+        edit = view.begin_edit()
+        view.insert(edit, 0, json.dumps(metrics.snapshot(), indent = 2, sort_keys = True))
+        view.end_edit(edit)
+
+class SublimeHaskellOpenFullLog(sublime_plugin.WindowCommand):
+    def run(self, panel = None):
+        log_path = get_output_log_path(panel) if panel else last_output_log
+        if log_path and os.path.exists(log_path):
+            self.window.open_file(log_path)
+        else:
+            sublime.status_message('SublimeHaskell: There is no output log')
+
+    def is_enabled(self):
+        return last_output_log is not None